@@ -0,0 +1,96 @@
+import argparse
+import random
+import string
+import time
+from collections import namedtuple
+
+from engine import MemberNameIndex, UserMatcher, transform_message
+
+# Offline benchmark for the message transform engine. Runs synthetic corpora through
+# transform_message and reports messages/sec plus the time spent in each stage.
+#   python bench.py                 # full sweep
+#   python bench.py --messages 500  # quicker run
+
+Member = namedtuple("Member", "id display_name name")
+
+STAGES = ("delimiter", "shortcuts", "strip", "counters", "append")
+BASELINE = {"length": 200, "phrases": 10, "shortcuts": 10, "members": 1000}
+SWEEPS = {
+    "length": (50, 200, 1000, 2000),
+    "phrases": (1, 10, 50, 200),
+    "shortcuts": (0, 10, 50, 200),
+    "members": (100, 1000, 10000, 50000),
+}
+DELIMITER = "!"
+
+def random_word(rng, low=3, high=9):
+    return "".join(rng.choices(string.ascii_lowercase, k=rng.randint(low, high)))
+
+def make_config(rng, phrases, shortcuts, members):
+    tracked = [random_word(rng).upper() for _ in range(phrases)]
+    shortcut_map = {random_word(rng, 2, 4): rng.choice(tracked) for _ in range(shortcuts)} if tracked else {}
+    names = [Member(i, random_word(rng, 4, 12).capitalize(), random_word(rng, 4, 12)) for i in range(members)]
+    return tracked, shortcut_map, names
+
+def make_corpus(rng, count, length, tracked, shortcut_map, names):
+    shortcut_keys = list(shortcut_map)
+    corpus = []
+    for _ in range(count):
+        words = []
+        size = 0
+        while size < length:
+            roll = rng.random()
+            if tracked and roll < 0.05:
+                word = rng.choice(tracked)
+                if rng.random() < 0.3:
+                    word += f" X{rng.randint(1, 500)}" # Previous counter to strip
+            elif shortcut_keys and roll < 0.08:
+                word = rng.choice(shortcut_keys)
+            elif names and roll < 0.1:
+                word = DELIMITER + rng.choice(names).display_name
+            else:
+                word = random_word(rng)
+            words.append(word)
+            size += len(word) + 1
+        corpus.append(" ".join(words)[:length])
+    return corpus
+
+def run_case(rng, messages, length, phrases, shortcuts, members):
+    tracked, shortcut_map, names = make_config(rng, phrases, shortcuts, members)
+    matcher = UserMatcher(tracked, shortcut_map)
+    index = MemberNameIndex()
+    for member in names:
+        index.add(member)
+    append_phrase = tracked[0] if tracked else None
+    corpus = make_corpus(rng, messages, length, tracked, shortcut_map, names)
+
+    stage_times = {}
+    started = time.perf_counter()
+    for content in corpus:
+        transform_message(
+            content, matcher, {}, append_phrase=append_phrase,
+            delimiter=DELIMITER, member_index=index, stage_times=stage_times,
+        )
+    elapsed = time.perf_counter() - started
+    return messages / elapsed, {stage: stage_times.get(stage, 0.0) / messages for stage in STAGES}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the message transform engine")
+    parser.add_argument("--messages", type=int, default=2000, help="Messages per case")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    header = f"{'case':<22}{'msgs/sec':>12}" + "".join(f"{stage + ' us':>14}" for stage in STAGES)
+    print(header)
+    print("-" * len(header))
+    for dimension, values in SWEEPS.items():
+        for value in values:
+            params = dict(BASELINE, **{dimension: value})
+            rng = random.Random(args.seed)
+            rate, per_stage = run_case(rng, args.messages, **params)
+            row = f"{dimension + '=' + str(value):<22}{rate:>12,.0f}"
+            row += "".join(f"{per_stage[stage] * 1e6:>14.1f}" for stage in STAGES)
+            print(row)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,438 @@
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+from engine import normalize_lookalikes
+
+# -------------- Interning --------------
+class Interner:
+    """
+    Maps strings to dense integer IDs and back, so each distinct string is stored once.
+    Stores that drop data can count references with retain() and release(); a string
+    whose last reference is released is forgotten and its ID reused.
+    """
+    __slots__ = ("ids", "strings", "refs", "free")
+
+    def __init__(self):
+        self.ids = {}  # string -> ID
+        self.strings = []  # ID -> string (None once released)
+        self.refs = {}  # ID -> reference count, for retained strings
+        self.free = []  # Released IDs
+
+    def intern(self, value):
+        value_id = self.ids.get(value)
+        if value_id is None:
+            if self.free:
+                value_id = self.free.pop()
+                self.strings[value_id] = value
+            else:
+                value_id = len(self.strings)
+                self.strings.append(value)
+            self.ids[value] = value_id
+        return value_id
+
+    def retain(self, value_id):
+        self.refs[value_id] = self.refs.get(value_id, 0) + 1
+
+    def release(self, value_id):
+        refs = self.refs[value_id] - 1
+        if refs:
+            self.refs[value_id] = refs
+            return
+        del self.refs[value_id]
+        del self.ids[self.strings[value_id]]
+        self.strings[value_id] = None
+        self.free.append(value_id)
+
+    def lookup(self, value):
+        """The ID of value, or None if it was never interned."""
+        return self.ids.get(value)
+
+    def __getitem__(self, value_id):
+        return self.strings[value_id]
+
+    def __len__(self):
+        return len(self.ids)
+
+# -------------- Counter Store --------------
+class CounterStore:
+    """
+    Per-channel phrase counters for every user in a guild.
+    User IDs, channel IDs and phrases are interned, and each (user, channel) pair keeps
+    its counters in one flat array of [phrase_id, count, phrase_id, count, ...], so a
+    counter costs two array slots instead of a dict entry plus its own key strings.
+    Users rarely track more than a handful of phrases, so lookups scan the array.
+    """
+    __slots__ = ("users", "channels", "phrases", "tables", "size")
+    complete = True  # Every counter is in memory, so rows() covers the whole data set
+
+    def __init__(self):
+        self.users = Interner()
+        self.channels = Interner()
+        self.phrases = Interner()
+        self.tables = {}  # user_index << 32 | channel_index -> array of phrase IDs and counts
+        self.size = 0  # Number of counters stored
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build a store from (user_id, channel_id, phrase, count) rows, each counter appearing once."""
+        store = cls()
+        tables = {}
+        for user_id, channel_id, phrase, count in rows:
+            key = store.users.intern(user_id) << 32 | store.channels.intern(channel_id)
+            table = tables.get(key)
+            if table is None:
+                table = tables[key] = []
+            table.append(store.phrases.intern(phrase))
+            table.append(count)
+        # Sized exactly, without the slack that growing an array one append at a time leaves
+        store.tables = {key: array("q", table) for key, table in tables.items()}
+        store.size = sum(len(table) for table in tables.values()) // 2
+        return store
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a store from the nested {user_id: {channel_id: {phrase: count}}} layout."""
+        return cls.from_rows(
+            (user_id, channel_id, phrase, count)
+            for user_id, channels in data.items()
+            for channel_id, phrases in channels.items()
+            for phrase, count in phrases.items()
+        )
+
+    def to_dict(self):
+        data = {}
+        for user_id, channel_id, phrase, count in self.rows():
+            data.setdefault(user_id, {}).setdefault(channel_id, {})[phrase] = count
+        return data
+
+    def _key(self, user_id, channel_id):
+        user_index = self.users.lookup(user_id)
+        channel_index = self.channels.lookup(channel_id)
+        if user_index is None or channel_index is None:
+            return None
+        return user_index << 32 | channel_index
+
+    def _resident(self, user_id, channel_id):
+        # The (user, channel) table if it's in memory, without creating it
+        key = self._key(user_id, channel_id)
+        return self.tables.get(key) if key is not None else None
+
+    # The table that reads use
+    _lookup = _resident
+
+    def _table(self, user_id, channel_id):
+        key = self.users.intern(user_id) << 32 | self.channels.intern(channel_id)
+        table = self.tables.get(key)
+        if table is None:
+            table = self.tables[key] = array("q")
+        return table
+
+    @staticmethod
+    def _find(table, phrase_id):
+        # Index of the count slot for phrase_id, or -1
+        for i in range(0, len(table), 2):
+            if table[i] == phrase_id:
+                return i + 1
+        return -1
+
+    def _get(self, table, phrase, default):
+        phrase_id = self.phrases.lookup(phrase)
+        if table is None or phrase_id is None:
+            return default
+        slot = self._find(table, phrase_id)
+        return table[slot] if slot >= 0 else default
+
+    def get(self, user_id, channel_id, phrase, default=0):
+        return self._get(self._lookup(user_id, channel_id), phrase, default)
+
+    def peek(self, user_id, channel_id, phrase, default=None):
+        """get() from memory only: nothing is paged in and cache stats aren't touched, for saving."""
+        return self._get(self._resident(user_id, channel_id), phrase, default)
+
+    def _added(self, phrase_id):
+        # Called when a table gains a counter for phrase_id
+        pass
+
+    def set(self, user_id, channel_id, phrase, count):
+        table = self._table(user_id, channel_id)
+        phrase_id = self.phrases.intern(phrase)
+        slot = self._find(table, phrase_id)
+        if slot >= 0:
+            table[slot] = count
+        else:
+            table.append(phrase_id)
+            table.append(count)
+            self.size += 1
+            self._added(phrase_id)
+
+    def increment(self, user_id, channel_id, phrase, delta=1):
+        """Add delta to a counter (missing counters start at 0) and return the new count."""
+        table = self._table(user_id, channel_id)
+        phrase_id = self.phrases.intern(phrase)
+        slot = self._find(table, phrase_id)
+        if slot >= 0:
+            table[slot] += delta
+            return table[slot]
+        table.append(phrase_id)
+        table.append(delta)
+        self.size += 1
+        self._added(phrase_id)
+        return delta
+
+    def channel(self, user_id, channel_id):
+        """A user's counters in one channel, as a {phrase: count} dict."""
+        table = self._lookup(user_id, channel_id)
+        if not table:
+            return {}
+        phrases = self.phrases
+        return {phrases[table[i]]: table[i + 1] for i in range(0, len(table), 2)}
+
+    def channel_counts(self, channel_id):
+        """Yield every counter in one channel as (user_id, phrase, count)."""
+        channel_index = self.channels.lookup(channel_id)
+        if channel_index is None:
+            return
+        users, phrases = self.users, self.phrases
+        for key, table in self.tables.items():
+            if key & 0xFFFFFFFF == channel_index:
+                user_id = users[key >> 32]
+                for i in range(0, len(table), 2):
+                    yield user_id, phrases[table[i]], table[i + 1]
+
+    def rows(self):
+        """Yield every counter as (user_id, channel_id, phrase, count)."""
+        users, channels, phrases = self.users, self.channels, self.phrases
+        for key, table in self.tables.items():
+            user_id = users[key >> 32]
+            channel_id = channels[key & 0xFFFFFFFF]
+            for i in range(0, len(table), 2):
+                yield user_id, channel_id, phrases[table[i]], table[i + 1]
+
+    def checkpoint(self):
+        """Called when a snapshot is taken for saving; returns what to run once it is written."""
+        return None
+
+    def __len__(self):
+        return self.size
+
+class TieredCounterStore(CounterStore):
+    """
+    CounterStore that keeps only the most recently used (user, channel) tables in memory.
+    Other tables stay on disk and are paged in through load_table(user_id, channel_id),
+    which returns that table's (phrase, count) rows, the first time they're used again.
+    load_channel(channel_id) returns a channel's stored (user_id, phrase, count) rows.
+    Once more than max_tables are resident, the least recently used one is dropped,
+    unless it has changes that haven't been written yet, along with any user, channel and
+    phrase strings no other resident table uses.
+    """
+    __slots__ = ("load_table", "load_channel", "max_tables", "unsaved", "version", "hits", "misses", "evictions")
+    complete = False
+
+    def __init__(self, load_table, max_tables, load_channel):
+        super().__init__()
+        self.load_table = load_table
+        self.load_channel = load_channel
+        self.max_tables = max_tables
+        self.tables = OrderedDict()  # Least recently used first
+        self.unsaved = {}  # table key -> version of its last change; pinned in memory until saved
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _cached(self, user_id, channel_id):
+        table = self._resident(user_id, channel_id)
+        if table is not None:
+            self.hits += 1
+            self.tables.move_to_end(self._key(user_id, channel_id))
+        else:
+            self.misses += 1
+        return table
+
+    def _page_in(self, user_id, channel_id, rows):
+        users, channels, phrases = self.users, self.channels, self.phrases
+        user_index = users.intern(user_id)
+        channel_index = channels.intern(channel_id)
+        users.retain(user_index)
+        channels.retain(channel_index)
+        table = array("q")
+        for phrase, count in rows:
+            phrase_id = phrases.intern(phrase)
+            phrases.retain(phrase_id)
+            table.append(phrase_id)
+            table.append(count)
+        key = user_index << 32 | channel_index
+        self.tables[key] = table
+        self.size += len(table) // 2
+        self._evict(keep=key)
+        return table
+
+    def _table(self, user_id, channel_id):
+        table = self._cached(user_id, channel_id)
+        if table is None:
+            table = self._page_in(user_id, channel_id, self.load_table(user_id, channel_id))
+        return table
+
+    def _lookup(self, user_id, channel_id):
+        # Reads page tables in too (a channel being read is a channel seeing activity), but a
+        # table with nothing stored isn't kept
+        table = self._cached(user_id, channel_id)
+        if table is None:
+            rows = list(self.load_table(user_id, channel_id))
+            if rows:
+                table = self._page_in(user_id, channel_id, rows)
+        return table
+
+    def channel_counts(self, channel_id):
+        # Resident tables may be newer than what's stored, so they replace their stored rows
+        channel_index = self.channels.lookup(channel_id)
+        resident = set()
+        if channel_index is not None:
+            resident = {self.users[key >> 32] for key in self.tables if key & 0xFFFFFFFF == channel_index}
+        for user_id, phrase, count in self.load_channel(channel_id):
+            if user_id not in resident:
+                yield user_id, phrase, count
+        yield from super().channel_counts(channel_id)
+
+    def _evict(self, keep=None):
+        while len(self.tables) > self.max_tables:
+            victim = next((key for key in self.tables if key not in self.unsaved and key != keep), None)
+            if victim is None:
+                return
+            table = self.tables.pop(victim)
+            self.size -= len(table) // 2
+            self.evictions += 1
+            self.users.release(victim >> 32)
+            self.channels.release(victim & 0xFFFFFFFF)
+            for i in range(0, len(table), 2):
+                self.phrases.release(table[i])
+
+    def _added(self, phrase_id):
+        self.phrases.retain(phrase_id)
+
+    def _changed(self, user_id, channel_id):
+        self.version += 1
+        self.unsaved[self._key(user_id, channel_id)] = self.version
+
+    def set(self, user_id, channel_id, phrase, count):
+        super().set(user_id, channel_id, phrase, count)
+        self._changed(user_id, channel_id)
+
+    def increment(self, user_id, channel_id, phrase, delta=1):
+        count = super().increment(user_id, channel_id, phrase, delta)
+        self._changed(user_id, channel_id)
+        return count
+
+    def checkpoint(self):
+        # Everything changed up to now is in the snapshot being written
+        version = self.version
+        return lambda: self.mark_saved(version)
+
+    def mark_saved(self, version):
+        """Unpin tables whose changes up to version have been written."""
+        self.unsaved = {key: changed for key, changed in self.unsaved.items() if changed > version}
+        self._evict()
+
+# -------------- Aggregates --------------
+def phrase_key(phrase):
+    # Users track phrases independently, so "RIP" and "rip" rank together. The same key as
+    # the default Normalizer's, so phrases rank together when they match the same text.
+    return normalize_lookalikes(phrase).lower()
+
+class Ranking:
+    """
+    Scores kept in sorted order, updated one change at a time: O(log n) to find an
+    entry, and the top N in O(N). Zero scores are dropped.
+    """
+    __slots__ = ("scores", "order", "total")
+
+    def __init__(self):
+        self.scores = {}  # key -> score
+        self.order = []  # (-score, key), best first
+        self.total = 0
+
+    @classmethod
+    def from_scores(cls, scores):
+        """Build a ranking from a {key: score} dict with a single sort."""
+        ranking = cls()
+        ranking.scores = {key: score for key, score in scores.items() if score}
+        ranking.order = sorted((-score, key) for key, score in ranking.scores.items())
+        ranking.total = sum(ranking.scores.values())
+        return ranking
+
+    def add(self, key, delta):
+        old = self.scores.get(key, 0)
+        new = old + delta
+        if old:
+            del self.order[bisect_left(self.order, (-old, key))]
+        if new:
+            insort(self.order, (-new, key))
+            self.scores[key] = new
+        else:
+            del self.scores[key]
+        self.total += delta
+
+    def top(self, n):
+        return [(key, -score) for score, key in self.order[:n]]
+
+    def rank(self, key):
+        """1-based position of key, or None if it has no score."""
+        score = self.scores.get(key)
+        if score is None:
+            return None
+        return bisect_left(self.order, (-score, key)) + 1
+
+class Aggregates:
+    """
+    Every user's total per phrase across channels, maintained as counters change, so totals
+    and the server leaderboard never scan every counter. A channel's leaderboard would need
+    a copy of every counter kept up to date, so it is built from that channel's counters
+    when asked for instead.
+    """
+    def __init__(self, counters, key=phrase_key):
+        self.counters = counters
+        self.key = key  # phrase -> the key it ranks under
+        self.phrases = {}  # phrase key -> Ranking of user IDs
+
+    @classmethod
+    def from_rows(cls, counters, rows, key=phrase_key):
+        totals = {}  # phrase key -> {user_id: total}
+        by_phrase = {}  # phrase -> its key's totals
+        for user_id, _, phrase, count in rows:
+            scores = by_phrase.get(phrase)
+            if scores is None:
+                scores = by_phrase[phrase] = totals.setdefault(key(phrase), {})
+            scores[user_id] = scores.get(user_id, 0) + count
+        aggregates = cls(counters, key)
+        aggregates.phrases = {key: Ranking.from_scores(scores) for key, scores in totals.items()}
+        return aggregates
+
+    def add(self, user_id, phrase, delta):
+        if not delta:
+            return
+        key = self.key(phrase)
+        ranking = self.phrases.get(key)
+        if ranking is None:
+            ranking = self.phrases[key] = Ranking()
+        ranking.add(user_id, delta)
+
+    def ranking(self, phrase, channel_id=None):
+        """The Ranking for a phrase, server-wide or in one channel (None if nobody has counted it)."""
+        key = self.key(phrase)
+        if channel_id is None:
+            return self.phrases.get(key)
+        scores = {}
+        matches = {}  # phrase -> whether it ranks under key, so each distinct phrase is keyed once
+        for user_id, counted, count in self.counters.channel_counts(channel_id):
+            match = matches.get(counted)
+            if match is None:
+                match = matches[counted] = self.key(counted) == key
+            if match:
+                scores[user_id] = scores.get(user_id, 0) + count
+        return Ranking.from_scores(scores) if scores else None
+
+    def total(self, user_id, phrase):
+        """A user's count of a phrase across all channels."""
+        ranking = self.ranking(phrase)
+        return ranking.scores.get(user_id, 0) if ranking else 0
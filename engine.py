@@ -0,0 +1,487 @@
+import re
+import string
+import time
+import unicodedata
+from bisect import bisect_left, insort
+from itertools import islice
+
+# -------------- Normalization --------------
+# Matching runs on a normalized copy of each message, made once per message, while edits
+# (shortcuts, counters) are applied to the original text so reposts keep what the user typed.
+APOSTROPHES = ["’", "‘", "ʼ", "‛", "＇", "՚", "ߵ", "ߴ"] # Because mobile and PC type different apostrophes
+QUOTES = ["“", "”", "„", "‟", "＂"]
+LOOKALIKES = str.maketrans({**{c: "'" for c in APOSTROPHES}, **{c: '"' for c in QUOTES}})
+
+def normalize_lookalikes(text: str) -> str:
+    """Map apostrophe and quote lookalikes to their ASCII forms in one pass."""
+    return text.translate(LOOKALIKES) if text else text
+
+class NormalizedText:
+    """
+    A text and its normalized form. offsets maps each normalized index (plus the end) to
+    the original index it came from; None means the two line up one to one.
+    """
+    __slots__ = ("original", "text", "offsets")
+
+    def __init__(self, original, text, offsets=None):
+        self.original = original
+        self.text = text
+        self.offsets = offsets
+
+    def apply(self, edits, normalizer):
+        """
+        Apply sorted, non-overlapping (start, end, replacement) edits given in normalized
+        coordinates to the original text, and return the NormalizedText of the result.
+        """
+        if not edits:
+            return self
+        original = self.splice_original(edits)
+        if normalizer.aligned:
+            # Lookalike mapping is one to one, so the normalized text can be spliced the same way
+            return NormalizedText(original, _splice(self.text, [(a, b, r.translate(LOOKALIKES)) for a, b, r in edits]))
+        return normalizer.normalize(original)
+
+    def splice_original(self, edits):
+        """Just the original text with edits applied, for when no more matching follows."""
+        if self.offsets is not None:
+            edits = [(self.offsets[a], self.offsets[b], r) for a, b, r in edits]
+        return _splice(self.original, edits)
+
+def _splice(text, edits):
+    parts = []
+    last = 0
+    for start, end, replacement in edits:
+        parts.append(text[last:start])
+        parts.append(replacement)
+        last = end
+    parts.append(text[last:])
+    return "".join(parts)
+
+class Normalizer:
+    """
+    Lookalike characters are always mapped with a single str.translate. NFKC (e.g. fullwidth
+    and ligature forms) and casefolding (e.g. "ß" matching "ss") are optional; they can change
+    the text's length, so non-ASCII text then gets an offset map back to the original.
+    """
+    def __init__(self, nfkc=False, casefold=False):
+        self.nfkc = nfkc
+        self.casefold = casefold
+        self.aligned = not (nfkc or casefold)  # Normalized text always lines up with the original
+
+    def normalize(self, text):
+        translated = text.translate(LOOKALIKES)
+        if self.aligned:
+            return NormalizedText(text, translated)
+        if translated.isascii():
+            return NormalizedText(text, translated.lower() if self.casefold else translated)
+        parts = []
+        offsets = []
+        aligned = True
+        for i, char in enumerate(translated):
+            if self.nfkc:
+                char = unicodedata.normalize("NFKC", char)
+            if self.casefold:
+                char = char.casefold()
+            parts.append(char)
+            offsets.extend([i] * len(char))
+            aligned = aligned and len(char) == 1
+        offsets.append(len(translated))
+        return NormalizedText(text, "".join(parts), None if aligned else offsets)
+
+    def key(self, text):
+        """Normalized, lowercased form of a phrase or shortcut, for lookups."""
+        return self.normalize(text).text.lower()
+
+DEFAULT_NORMALIZER = Normalizer()
+
+# -------------- Member Name Index --------------
+# Prefix trie of casefolded display names and usernames, so a delimiter mention resolves
+# in time proportional to the name length instead of the member count.
+# Match rule: the longest name wins. If several members share that name, a display
+# name beats a username, and ties after that go to the lowest member ID.
+class MemberNameIndex:
+    def __init__(self):
+        self.root = {}
+        self.names = {}  # member_id -> (display_name, username)
+        self.complete = False
+        self.version = 0  # Bumped on every change
+
+    def add(self, member):
+        self.add_names(member.id, member.display_name, member.name)
+
+    def add_names(self, member_id, display_name, username):
+        names = (display_name, username)
+        if self.names.get(member_id) == names:
+            return
+        self.remove(member_id)
+        self.version += 1
+        self.names[member_id] = names
+        for priority, name in enumerate(names):
+            key = name.casefold()
+            if not key:
+                continue
+            node = self.root
+            for ch in key:
+                node = node.setdefault(ch, {})
+            # Terminal entries live under the None key: member_id -> priority
+            entries = node.setdefault(None, {})
+            entries[member_id] = min(priority, entries.get(member_id, priority))
+
+    def prefixed(self, prefix):
+        """IDs of the members with a name starting with prefix (casefolded)."""
+        node = self.root
+        for ch in prefix:
+            node = node.get(ch)
+            if node is None:
+                return set()
+        found = set()
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            for ch, child in node.items():
+                if ch is None:
+                    found.update(child)
+                else:
+                    nodes.append(child)
+        return found
+
+    def remove(self, member_id):
+        names = self.names.pop(member_id, None)
+        if names is None:
+            return
+        self.version += 1
+        for name in names:
+            key = name.casefold()
+            path = [self.root]
+            for ch in key:
+                node = path[-1].get(ch)
+                if node is None:
+                    break
+                path.append(node)
+            else:
+                entries = path[-1].get(None, {})
+                entries.pop(member_id, None)
+                if not entries:
+                    path[-1].pop(None, None)
+                # Prune branches that no longer lead to any name
+                for depth in range(len(key), 0, -1):
+                    if path[depth]:
+                        break
+                    del path[depth - 1][key[depth - 1]]
+
+    def match(self, content, start):
+        """Return (member_id, end) for the longest name starting at content[start], or None."""
+        node = self.root
+        best = None
+        i = start
+        n = len(content)
+        while i < n:
+            for ch in content[i].casefold():
+                node = node.get(ch)
+                if node is None:
+                    return best
+            i += 1
+            entries = node.get(None)
+            if entries:
+                member_id = min(entries, key=lambda m: (entries[m], m))
+                best = (member_id, i)
+        return best
+
+# Replace occurrences of the delimiter + display name with real mentions.
+def replace_delimiter_mentions(content, index, delimiter="!"):
+    result = []
+    i = 0
+    n = len(content)
+
+    while i < n:
+        j = content.find(delimiter, i)
+        if j == -1:
+            result.append(content[i:])
+            break
+        result.append(content[i:j])
+
+        found = index.match(content, j + 1)
+        if found:
+            member_id, i = found
+            result.append(f"<@{member_id}>")
+        else:
+            # No match → keep the delimiter as-is
+            result.append(delimiter)
+            i = j + 1
+
+    return "".join(result)
+
+# -------------- Phrase Index --------------
+# A user's tracked phrases and shortcut targets by Normalizer.key, for the slash commands, so
+# they treat two phrases as the same exactly when the matcher does:
+# membership checks are a dict lookup, and each key list is kept sorted, so the keys that
+# start with what the user has typed so far are one contiguous run found by bisection.
+class PhraseIndex:
+    def __init__(self, phrases=(), shortcuts=None, normalizer=DEFAULT_NORMALIZER):
+        self.key = normalizer.key
+        self.phrases = {}  # key -> tracked phrase
+        self.phrase_keys = []  # sorted
+        self.shortcuts = {}  # shortcut key -> (shortcut, target key)
+        self.targets = {}  # target key -> (target, [shortcuts])
+        self.target_keys = []  # sorted
+        for phrase in phrases:
+            self.add_phrase(phrase)
+        for shortcut, target in (shortcuts or {}).items():
+            self.add_shortcut(shortcut, target)
+
+    def tracked(self, phrase):
+        """The tracked phrase matching phrase, as it was tracked, or None."""
+        return self.phrases.get(self.key(phrase))
+
+    def add_phrase(self, phrase):
+        key = self.key(phrase)
+        if key not in self.phrases:
+            insort(self.phrase_keys, key)
+        self.phrases[key] = phrase
+
+    def remove_phrase(self, phrase):
+        key = self.key(phrase)
+        if self.phrases.pop(key, None) is not None:
+            del self.phrase_keys[bisect_left(self.phrase_keys, key)]
+
+    def has_shortcut(self, shortcut):
+        return self.key(shortcut) in self.shortcuts
+
+    def shortcuts_for(self, target):
+        """The shortcuts that expand to target."""
+        entry = self.targets.get(self.key(target))
+        return list(entry[1]) if entry else []
+
+    def add_shortcut(self, shortcut, target):
+        self.remove_shortcut(shortcut)
+        key = self.key(target)
+        entry = self.targets.get(key)
+        if entry is None:
+            entry = self.targets[key] = (target, [])
+            insort(self.target_keys, key)
+        entry[1].append(shortcut)
+        self.shortcuts[self.key(shortcut)] = (shortcut, key)
+
+    def remove_shortcut(self, shortcut):
+        found = self.shortcuts.pop(self.key(shortcut), None)
+        if found is None:
+            return
+        shortcut, key = found
+        shortcuts = self.targets[key][1]
+        shortcuts.remove(shortcut)
+        if not shortcuts:
+            del self.targets[key]
+            del self.target_keys[bisect_left(self.target_keys, key)]
+
+    @staticmethod
+    def _prefixed(keys, prefix):
+        for i in range(bisect_left(keys, prefix), len(keys)):
+            if not keys[i].startswith(prefix):
+                return
+            yield keys[i]
+
+    def complete_phrases(self, text, limit=25):
+        """Tracked phrases starting with text, case-insensitively, in key order."""
+        return [self.phrases[key] for key in islice(self._prefixed(self.phrase_keys, self.key(text)), limit)]
+
+    def complete_targets(self, text, limit=25, untracked=False):
+        """Shortcut targets starting with text, case-insensitively, in key order; untracked ones only if untracked is set."""
+        keys = self._prefixed(self.target_keys, self.key(text))
+        if untracked:
+            keys = (key for key in keys if key not in self.phrases)
+        return [self.targets[key][0] for key in islice(keys, limit)]
+
+# -------------- Compiled Matchers --------------
+# A user's shortcuts and tracked phrases normalized and compiled into combined patterns
+# once, then reused for every message until their configuration changes.
+class UserMatcher:
+    def __init__(self, phrases, shortcuts, normalizer=DEFAULT_NORMALIZER):
+        self.normalizer = normalizer
+        self.phrase_list = list(phrases)
+        self.shortcuts = shortcuts
+        self.shortcut_targets = {normalizer.key(s): t for s, t in shortcuts.items()}
+        self.shortcut_pattern = None
+        if shortcuts:
+            # Longest first so a shortcut never shadows a longer one sharing its prefix
+            norm_shortcuts = sorted((normalizer.normalize(s).text for s in shortcuts), key=len, reverse=True)
+            alternatives = "|".join(re.escape(s) for s in norm_shortcuts)
+            self.shortcut_pattern = re.compile(r'\b(?:' + alternatives + r')\b', re.IGNORECASE)
+
+        self.strip_pattern = None
+        self.count_pattern = None
+        self.phrases = {}
+        self.phrase_keys = []
+        self.normalized_phrases = []  # (normalized phrase, phrase), for matches lower() can't key
+        if phrases:
+            norm_phrases = [normalizer.normalize(p).text for p in phrases]
+            self.normalized_phrases = list(zip(norm_phrases, phrases))
+            self.phrases = {norm.lower(): phrase for phrase, norm in zip(phrases, norm_phrases)}
+            self.phrase_keys = list(self.phrases)
+            # Longest first, so overlapping phrases resolve to the longest one at each position
+            alternatives = "|".join(re.escape(p) for p in sorted(norm_phrases, key=len, reverse=True))
+            # Match cases like "RIP X172" or ":thumbsup: X5"
+            self.strip_pattern = re.compile(r'(?<!\w)(' + alternatives + r')\s*X\d+', re.IGNORECASE)
+            self.count_pattern = re.compile(r'(?<!\w)(?:' + alternatives + r')(?!\w)', re.IGNORECASE)
+
+    def shortcut_target(self, text):
+        """The phrase the shortcut matched as text expands to (text itself if none does)."""
+        target = self.shortcut_targets.get(text.lower())
+        if target is None:
+            # Case folding that doesn't round-trip through lower(), e.g. the Kelvin sign
+            target = next((
+                t for s, t in self.shortcuts.items()
+                if re.fullmatch(re.escape(self.normalizer.normalize(s).text), text, re.IGNORECASE)
+            ), text)
+        return target
+
+    def tracked_phrase(self, text):
+        """The tracked phrase matched as text, or None."""
+        phrase = self.phrases.get(text.lower())
+        if phrase is None:
+            # Same as shortcut_target: lower() can change the length (e.g. "İ"), so match the phrase's own text
+            phrase = next((
+                p for n, p in self.normalized_phrases if re.fullmatch(re.escape(n), text, re.IGNORECASE)
+            ), None)
+        return phrase
+
+    def count_edits(self, text, counters):
+        """
+        Find every tracked phrase in normalized text in a single scan and return the
+        " X{n}" insertions as edits, plus per-phrase hit counts, without modifying counters.
+        Matches never overlap; at each position the longest tracked phrase wins.
+        """
+        edits = []
+        hits = {}
+        if not self.count_pattern:
+            return edits, hits
+        for match in self.count_pattern.finditer(text):
+            phrase = self.tracked_phrase(match.group(0))
+            if phrase is None:
+                continue
+            hits[phrase] = hits.get(phrase, 0) + 1
+            edits.append((match.end(), match.end(), f" X{counters.get(phrase, 0) + hits[phrase]}"))
+        return edits, hits
+
+    def at_edges(self, text):
+        """Whether a tracked phrase starts or ends normalized text, ignoring counters and punctuation."""
+        edges = edge_text(text)
+        return any(edges.startswith(key) or edges.endswith(key) for key in self.phrase_keys)
+
+# -------------- Message Transform --------------
+COUNTER_SUFFIX = re.compile(r' X\d+')
+TRAILING_PUNCTUATION = re.compile(r'[.!?,;:]+$')
+
+def edge_text(text):
+    # Counters removed, and only standard whitespace and punctuation stripped, keeping emojis
+    # and other Unicode chars
+    return COUNTER_SUFFIX.sub('', text).strip().strip(string.whitespace + string.punctuation).lower()
+
+def compare_key(text):
+    # Counters and trailing punctuation removed, for comparing a message to the append phrase
+    return TRAILING_PUNCTUATION.sub('', COUNTER_SUFFIX.sub('', text)).strip().lower()
+
+def _lap(stage_times, stage, started):
+    now = time.perf_counter()
+    stage_times[stage] = stage_times.get(stage, 0.0) + now - started
+    return now
+
+def transform_message(content, matcher, counters, append_phrase=None, delimiter=None, member_index=None, stage_times=None):
+    """
+    Apply delimiter mentions, shortcuts, tracked phrase counters and the append phrase to a message.
+    counters is the user's current counts in the channel and is not modified.
+    Returns (modified, deltas, updated): the new text, per-phrase counter increments, and whether
+    the text changed. If stage_times is a dict, seconds spent in each stage are added to it.
+    Phrases are matched on the normalized text; the result keeps the original characters.
+    """
+    normalizer = matcher.normalizer
+    modified = content or ""
+    updated = False
+    skip_append = False
+    deltas = {}
+    if stage_times is not None:
+        started = time.perf_counter()
+
+    # Apply delimiter-based mention replacement to modified message
+    if delimiter and member_index is not None:
+        new_modified = replace_delimiter_mentions(modified, member_index, delimiter=delimiter)
+        if new_modified != modified:
+            modified = new_modified
+            updated = True
+    if stage_times is not None:
+        started = _lap(stage_times, "delimiter", started)
+
+    # Normalized once; each stage below edits the original through it
+    view = normalizer.normalize(modified)
+
+    # If shortcut expansion resulted in exactly the append phrase, skip appending
+    if append_phrase and modified:
+        if compare_key(view.text) == compare_key(normalizer.normalize(append_phrase).text):
+            skip_append = True
+
+    # Apply shortcuts
+    if modified and matcher.shortcut_pattern:
+        edits = []
+        for match in matcher.shortcut_pattern.finditer(view.text):
+            # If shortcut occurs at the start (ignoring leading punctuation/whitespace)
+            if not view.text[:match.start()].strip(string.punctuation + string.whitespace):
+                skip_append = True
+            edits.append((match.start(), match.end(), matcher.shortcut_target(match.group(0))))
+        if edits:
+            view = view.apply(edits, normalizer)
+            modified = view.original
+            updated = True
+    if stage_times is not None:
+        started = _lap(stage_times, "shortcuts", started)
+
+    # Remove existing counters like "phrase X123"
+    if modified and matcher.strip_pattern:
+        edits = [(match.end(1), match.end(), "") for match in matcher.strip_pattern.finditer(view.text)]
+        view = view.apply(edits, normalizer)
+        modified = view.original
+    if stage_times is not None:
+        started = _lap(stage_times, "strip", started)
+
+    # Apply tracked phrase counters. The normalized text isn't updated: the append check
+    # below ignores counters anyway
+    if modified:
+        edits, deltas = matcher.count_edits(view.text, counters)
+        if deltas:
+            modified = view.splice_original(edits)
+            updated = True
+    if stage_times is not None:
+        started = _lap(stage_times, "counters", started)
+
+    # Apply append phrase
+    if append_phrase and not skip_append:
+        content_to_check = modified.strip()
+        # Skip if fully enclosed
+        if not ((content_to_check.startswith('(') and content_to_check.endswith(')')) or
+                (content_to_check.startswith('{') and content_to_check.endswith('}')) or
+                (content_to_check.startswith('[') and content_to_check.endswith(']'))):
+            # Skip if any tracked phrase is at start or end
+            if not matcher.at_edges(view.text):
+                if append_phrase in matcher.phrase_list:
+                    deltas[append_phrase] = deltas.get(append_phrase, 0) + 1
+                    append_count = counters.get(append_phrase, 0) + deltas[append_phrase]
+                    append_text = f"{append_phrase} X{append_count}"
+                else:
+                    append_text = append_phrase
+
+                m = re.search(r'([.!?]+)$', content_to_check)
+                if m:
+                    punct = m.group(1)
+                    core = content_to_check[:-len(punct)]
+                else:
+                    core = content_to_check
+                    punct = ''
+                modified = f"{core}, {append_text}{punct}"
+                updated = True
+    if stage_times is not None:
+        _lap(stage_times, "append", started)
+
+    return modified, deltas, updated
+
+def timed_transform(*args, **kwargs):
+    """transform_message for executors: returns (result, stage_times), since a worker process can't fill in the caller's dict."""
+    stage_times = {}
+    return transform_message(*args, stage_times=stage_times, **kwargs), stage_times
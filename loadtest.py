@@ -0,0 +1,317 @@
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+import discord
+
+# Offline load test: drives the real on_message handler, webhook manager, dispatcher,
+# persistence and slash command callbacks from main.py against fake Discord objects.
+#   python loadtest.py --messages 5000 --rate 200
+#   python loadtest.py --latency-ms 80 --rate-limit 0.05
+#   python loadtest.py --replay recorded.jsonl
+# Replay files have one JSON object per line: {"t": seconds, "user": id, "channel": id, "content": text}
+
+# -------------- Fake Discord --------------
+class FakeNetwork:
+    """Simulated API round trips: latency with jitter, and 429s the client waits out and retries."""
+    def __init__(self, latency, jitter, rate_limit, retry_after, rng):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.rng = rng
+        self.requests = 0
+        self.rate_limited = 0
+
+    async def request(self):
+        while True:
+            self.requests += 1
+            await asyncio.sleep(max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter)))
+            if self.rng.random() >= self.rate_limit:
+                return
+            # discord.py sleeps for retry_after and retries transparently
+            self.rate_limited += 1
+            await asyncio.sleep(self.retry_after)
+
+class FakeAvatar:
+    url = "https://cdn.discordapp.com/embed/avatars/0.png"
+
+class FakeMember:
+    def __init__(self, member_id, display_name, name):
+        self.id = member_id
+        self.display_name = display_name
+        self.name = name
+        self.bot = False
+        self.mention = f"<@{member_id}>"
+        self.display_avatar = FakeAvatar()
+
+    def __str__(self):
+        return self.name
+
+class FakeWebhook:
+    def __init__(self, name, channel, network):
+        self.name = name
+        self.token = "fake-token"
+        self.channel_id = channel.id
+        self.network = network
+        self.sent = 0
+
+    async def send(self, content=None, wait=False, files=None, thread=None, **kwargs):
+        await self.network.request()
+        self.sent += 1
+
+class FakeChannel:
+    def __init__(self, channel_id, network):
+        self.id = channel_id
+        self.network = network
+        self.hooks = []
+
+    async def webhooks(self):
+        await self.network.request()
+        return list(self.hooks)
+
+    async def create_webhook(self, name):
+        await self.network.request()
+        webhook = FakeWebhook(name, self, self.network)
+        self.hooks.append(webhook)
+        return webhook
+
+class FakeGuild:
+    def __init__(self, guild_id, members, network, chunked):
+        self.id = guild_id
+        self.all_members = members
+        self.network = network
+        self.chunked = chunked
+        self.filesize_limit = 25 * 1024 * 1024
+        self._members = {m.id: m for m in members}
+        self.member_queries = 0
+
+    @property
+    def members(self):
+        # Without chunking, the member cache starts out empty
+        return self.all_members if self.chunked else []
+
+    def get_member(self, member_id):
+        return self._members.get(member_id)
+
+    async def query_members(self, query=None, *, limit=5, user_ids=None, cache=True):
+        # Gateway member requests match usernames and nicknames by prefix, or exact IDs
+        self.member_queries += 1
+        await self.network.request()
+        if user_ids is not None:
+            return [self._members[i] for i in user_ids if i in self._members][:limit]
+        return [m for m in self.all_members if m.name.casefold().startswith(query) or m.display_name.casefold().startswith(query)][:limit]
+
+    def get_role(self, role_id):
+        return None
+
+class FakeMessage:
+    def __init__(self, message_id, content, author, channel, guild, network):
+        self.id = message_id
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = guild
+        self.network = network
+        self.type = discord.MessageType.default
+        self.attachments = []
+        self.reference = None
+        self.received_at = None
+        self.reposted_at = None
+
+    async def delete(self):
+        # The repost is visible once webhook.send returns, which is right before the delete
+        self.reposted_at = time.perf_counter()
+        await self.network.request()
+
+class FakeResponse:
+    async def send_message(self, *args, **kwargs):
+        pass
+
+class FakeInteraction:
+    def __init__(self, user, channel, guild):
+        self.user = user
+        self.channel = channel
+        self.guild_id = guild.id
+        self.response = FakeResponse()
+
+# -------------- Harness --------------
+def import_bot(workdir, guild_id):
+    """Import main.py with a throwaway token, guild ID and data directory."""
+    os.chdir(workdir)
+    with open("bot.token", "w") as f:
+        f.write("offline")
+    with open("guild.id", "w") as f:
+        f.write(str(guild_id))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    return importlib.import_module("main")
+
+def random_word(rng, low=3, high=9):
+    return "".join(rng.choices(string.ascii_lowercase, k=rng.randint(low, high)))
+
+async def configure_users(bot_main, users, channel, guild, rng):
+    """Give every user tracked phrases, shortcuts, an append phrase and a delimiter via the slash commands."""
+    configs = {}
+    for user in users:
+        interaction = FakeInteraction(user, channel, guild)
+        phrases = [random_word(rng).upper() for _ in range(rng.randint(1, 10))]
+        for phrase in phrases:
+            await bot_main.track.callback(interaction, phrase)
+        shortcuts = {}
+        for _ in range(rng.randint(0, 5)):
+            shortcut = random_word(rng, 2, 3)
+            shortcuts[shortcut] = rng.choice(phrases)
+            await bot_main.shortcut_add.callback(interaction, shortcuts[shortcut], shortcut)
+        if rng.random() < 0.5:
+            await bot_main.append_command.callback(interaction, phrases[0])
+        if rng.random() < 0.3:
+            await bot_main.set_delimiter.callback(interaction, "!")
+        configs[user.id] = (phrases, list(shortcuts))
+    return configs
+
+def generate_stream(rng, count, rate, users, channels, members, configs):
+    stream = []
+    t = 0.0
+    for _ in range(count):
+        t += rng.expovariate(rate)
+        user = rng.choice(users)
+        phrases, shortcuts = configs[user.id]
+        words = []
+        for _ in range(rng.randint(3, 40)):
+            roll = rng.random()
+            if roll < 0.1:
+                words.append(rng.choice(phrases))
+            elif shortcuts and roll < 0.15:
+                words.append(rng.choice(shortcuts))
+            elif roll < 0.18:
+                words.append("!" + rng.choice(members).display_name)
+            else:
+                words.append(random_word(rng))
+        stream.append((t, user.id, rng.choice(channels).id, " ".join(words)))
+    return stream
+
+def load_stream(path):
+    stream = []
+    with open(path, "r") as f:
+        for line in f:
+            if line.strip():
+                event = json.loads(line)
+                stream.append((float(event["t"]), int(event["user"]), int(event["channel"]), event["content"]))
+    stream.sort()
+    return stream
+
+async def monitor_loop_lag(samples, interval, stop):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+async def run(args):
+    rng = random.Random(args.seed)
+    network = FakeNetwork(args.latency_ms / 1000, args.jitter_ms / 1000, args.rate_limit, args.retry_after_ms / 1000, rng)
+    workdir = tempfile.mkdtemp(prefix="counterbot-loadtest-")
+    bot_main = import_bot(workdir, guild_id=1)
+
+    async def no_commands(message):
+        pass
+    async def no_sync(data, command_guild):
+        pass
+    # Prefix commands and command sync need a logged-in bot user; slash commands are driven directly below
+    bot_main.bot.process_commands = no_commands
+    bot_main.sync_commands = no_sync
+
+    members = [FakeMember(10_000 + i, random_word(rng, 4, 12).capitalize(), random_word(rng, 4, 12)) for i in range(args.members)]
+    users = members[:args.users]
+    guild = FakeGuild(1, members, network, chunked=bot_main.MEMBER_LOADING == "chunk")
+    channels = [FakeChannel(100 + i, network) for i in range(args.channels)]
+    # Loads each configured guild's data and starts its background saver
+    await bot_main.bot.setup_hook()
+    configs = await configure_users(bot_main, users, channels[0], guild, rng)
+
+    if args.replay:
+        stream = load_stream(args.replay)
+        for _, user_id, _, _ in stream:
+            if user_id not in guild._members:
+                member = FakeMember(user_id, f"User{user_id}", f"user{user_id}")
+                guild.all_members.append(member)
+                guild._members[user_id] = member
+        channels_by_id = {c.id: c for c in channels}
+        for _, _, channel_id, _ in stream:
+            channels_by_id.setdefault(channel_id, FakeChannel(channel_id, network))
+    else:
+        stream = generate_stream(rng, args.messages, args.rate, users, channels, members, configs)
+        channels_by_id = {c.id: c for c in channels}
+
+    lag_samples = []
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(monitor_loop_lag(lag_samples, 0.01, stop))
+
+    messages = []
+    started = time.perf_counter()
+    for i, (offset, user_id, channel_id, content) in enumerate(stream):
+        delay = started + offset - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        message = FakeMessage(i, content, guild.get_member(user_id), channels_by_id[channel_id], guild, network)
+        message.received_at = time.perf_counter()
+        messages.append(message)
+        # Each gateway event runs in its own task, like discord.py's dispatch
+        asyncio.create_task(bot_main.on_message(message))
+
+    # Wait for every channel queue to drain
+    await asyncio.sleep(0)
+    while bot_main.dispatcher.queues:
+        await asyncio.gather(*(q.join() for q in list(bot_main.dispatcher.queues.values())))
+        if all(q.empty() for q in bot_main.dispatcher.queues.values()):
+            break
+    await asyncio.gather(*bot_main.pending_deletes)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await lag_task
+    await bot_main.close_all_data()
+
+    latencies = [m.reposted_at - m.received_at for m in messages if m.reposted_at]
+    print(f"Messages:          {len(messages)} in {elapsed:.2f}s ({len(messages) / elapsed:,.1f} msgs/sec)")
+    degraded = bot_main.metrics.counters.get("reposts_degraded", 0)
+    print(f"Reposted:          {len(latencies)}  (dropped reposts: {bot_main.dispatcher.dropped_reposts}, degraded mode: {degraded})")
+    print(f"API requests:      {network.requests}  (429s: {network.rate_limited})")
+    print(f"Repost latency:    p50 {percentile(latencies, 50) * 1000:.1f} ms   p99 {percentile(latencies, 99) * 1000:.1f} ms")
+    print(f"Event loop lag:    p50 {percentile(lag_samples, 50) * 1000:.2f} ms   p99 {percentile(lag_samples, 99) * 1000:.2f} ms   max {max(lag_samples, default=0) * 1000:.2f} ms")
+    offloaded = bot_main.metrics.counters.get("transforms_offloaded", 0)
+    print(f"Offloaded:         {offloaded} transforms  (loop stalls seen by the bot: {bot_main.lag_monitor.stalls})")
+    print(f"Member lookups:    {guild.member_queries}  (mode: {bot_main.MEMBER_LOADING})")
+    deepest = max(bot_main.dispatcher.high_water.values(), default=0)
+    print(f"Deepest queue:     {deepest} / {bot_main.CHANNEL_QUEUE_SIZE}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for the Counter bot")
+    parser.add_argument("--messages", type=int, default=2000, help="Generated messages to send")
+    parser.add_argument("--rate", type=float, default=200, help="Target messages/sec for generated streams")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--members", type=int, default=5000, help="Guild member count (for delimiter mentions)")
+    parser.add_argument("--latency-ms", type=float, default=50, help="Mean simulated API latency")
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="Probability a request gets a 429")
+    parser.add_argument("--retry-after-ms", type=float, default=500, help="Wait after a 429")
+    parser.add_argument("--replay", help="JSONL file of recorded messages to replay at their original timing")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    args.users = min(args.users, args.members)
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
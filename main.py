@@ -1,342 +1,1129 @@
+import asyncio
+import contextlib
+import functools
+import hashlib
 import json
+import multiprocessing
 import os
 import re
-import string
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import aiohttp
 import discord
 from discord.ext import commands
 from discord import app_commands
 from discord import AllowedMentions
+from counters import Aggregates, TieredCounterStore
+from engine import (
+    MemberNameIndex, Normalizer, PhraseIndex, UserMatcher, normalize_lookalikes, replace_delimiter_mentions, timed_transform, transform_message
+)
+from metrics import Metrics
+from ratelimit import RateGovernor, TokenBucket
+from storage import COUNTERS, DATASETS, JsonBackend, SqliteBackend, WriteBehind, dump_json, load_json, write_atomic, write_json_atomic
 
-# Read token and guild ID
+# Read token and guild IDs (one per line)
 with open("bot.token", "r") as f:
     TOKEN = f.read().strip()
 with open("guild.id", "r") as f:
-    GUILD_ID = int(f.read().strip())
+    GUILD_IDS = [int(line) for line in f.read().split()]
 
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
-bot = commands.Bot(command_prefix=commands.when_mentioned, intents=intents)
+# "chunk": download every member of each guild at startup. "lazy": look members up as they're
+# mentioned instead, for large guilds (see Member Name Index)
+MEMBER_LOADING = "lazy"
+
+class CounterBot(commands.AutoShardedBot):
+    async def setup_hook(self):
+        # Runs once, before connecting to the gateway. on_ready fires again after every
+        # reconnect, so loading data or syncing there would clobber unsaved counters.
+        for guild_id in GUILD_IDS:
+            data = get_guild_data(guild_id)
+            await sync_commands(data, discord.Object(id=guild_id))
+        if METRICS_FILE:
+            self.metrics_task = asyncio.create_task(write_metrics_file())
+        if MEMBER_LOADING == "lazy" and MEMBER_INDEX_FILE:
+            self.member_index_task = asyncio.create_task(save_member_indexes_periodically())
+        if LOOP_LAG_INTERVAL:
+            self.lag_task = asyncio.create_task(lag_monitor.run())
+        if TRANSFORM_OFFLOAD == "process":
+            # Fork the workers now, while this process is still small and single-threaded
+            await asyncio.get_running_loop().run_in_executor(transform_executor, int)
+
+    async def close(self):
+        # Count what's still queued, let reposted originals finish deleting, then a guaranteed
+        # final flush of anything still waiting to be saved
+        await dispatcher.drain(SHUTDOWN_DRAIN_TIMEOUT)
+        await asyncio.gather(*pending_deletes, return_exceptions=True)
+        await save_member_indexes()
+        await close_all_data()
+        await attachment_fetcher.close()
+        if transform_executor is not None:
+            transform_executor.shutdown(wait=False)
+        await super().close()
+
+# Shards are assigned automatically by Discord's recommended shard count
+bot = CounterBot(command_prefix=commands.when_mentioned, intents=intents, chunk_guilds_at_startup=MEMBER_LOADING == "chunk")
 
 # -------------- Data Paths and Setup --------------
+# Each guild's data lives in its own directory, data/<guild_id>/
 DATA_DIR = "data"
 os.makedirs(DATA_DIR, exist_ok=True)
 
-TRACK_FILE = os.path.join(DATA_DIR, "tracked_phrases.json")
-COUNTERS_FILE = os.path.join(DATA_DIR, "counters.json")
-APPEND_FILE = os.path.join(DATA_DIR, "append_phrases.json")
-SHORTCUT_FILE = os.path.join(DATA_DIR, "shortcuts.json")
-REPOST_FILE = os.path.join(DATA_DIR, "repost.json")
-REPLY_FILE = os.path.join(DATA_DIR, "reply.json")
-DELIMITER_FILE = os.path.join(DATA_DIR, "delimiters.json")
-
-# Initialize in-memory reply_data
-reply_data = {}
-
-def load_reply():
-    global reply_data
-    reply_data = load_json(REPLY_FILE)
-    return reply_data
-
-def save_reply():
-    save_json(REPLY_FILE, reply_data)
-
-# JSON helpers
-def load_json(path):
-    if not os.path.exists(path):
-        with open(path, "w") as f:
-            json.dump({}, f)
-        return {}
-    with open(path, "r") as f:
-        return json.load(f)
-
-def save_json(path, data):
-    with open(path, "w") as f:
-        json.dump(data, f, indent=4)
-
-# Global in-memory data
-tracking_data = {}
-counters_data = {}
-append_data = {}
-shortcuts_data = {}
-repost_data = {}
-delimiters_data = {}
-
-def load_all_data():
-    global tracking_data, counters_data, append_data, shortcuts_data, repost_data, reply_data, delimiters_data
-    tracking_data = load_json(TRACK_FILE)
-    counters_data = load_json(COUNTERS_FILE)
-    append_data = load_json(APPEND_FILE)
-    shortcuts_data = load_json(SHORTCUT_FILE)
-    repost_data = load_json(REPOST_FILE)
-    reply_data = load_json(REPLY_FILE)
-    delimiters_data = load_json(DELIMITER_FILE)
-
-def save_all_data():
-    save_json(TRACK_FILE, tracking_data)
-    save_json(COUNTERS_FILE, counters_data)
-    save_json(APPEND_FILE, append_data)
-    save_json(SHORTCUT_FILE, shortcuts_data)
-    save_json(REPOST_FILE, repost_data)
-    save_json(REPLY_FILE, reply_data)
-    save_json(DELIMITER_FILE, delimiters_data)
-
-# Guild object
-guild = discord.Object(id=GUILD_ID)
-
-# -------------- Helper Functions --------------
-APOSTROPHES = ["’", "‘", "ʼ", "‛", "＇", "՚", "ߵ", "ߴ"] # Because mobile and PC type different apostrophes
-def normalize_apostrophes(text: str) -> str:
-    if not text:
-        return text
-    for char in APOSTROPHES:
-        text = text.replace(char, "'")
-    return text
-
-def escape_mentions(text: str, guild: discord.Guild) -> str:
+# Data set names; with the JSON backend each one is stored as data/<guild_id>/<name>.json
+TRACK_DATA = "tracked_phrases"
+COUNTERS_DATA = COUNTERS
+APPEND_DATA = "append_phrases"
+SHORTCUT_DATA = "shortcuts"
+REPOST_DATA = "repost"
+REPLY_DATA = "reply"
+DELIMITER_DATA = "delimiters"
+
+# "sqlite" stores each guild's data in DATABASE_NAME and imports existing JSON files on first run;
+# "json" keeps the original one-file-per-data-set layout
+STORAGE_BACKEND = "sqlite"
+DATABASE_NAME = "counterbot.db"
+# JSON backend only: counter changes are journaled, then compacted into counters.json
+# once this many entries have accumulated
+JOURNAL_COMPACT_ENTRIES = 10000
+# SQLite backend only: (user, channel) counter tables kept in memory per guild. The least
+# recently active are dropped once there are more, and read back from the database when
+# that channel is active again. None keeps every counter in memory.
+COUNTER_CACHE_SIZE = 50000
+
+def open_backend(directory):
+    if STORAGE_BACKEND == "json":
+        return JsonBackend(directory, compact_after=JOURNAL_COMPACT_ENTRIES)
+    return SqliteBackend(os.path.join(directory, DATABASE_NAME), data_dir=directory, counter_cache=COUNTER_CACHE_SIZE)
+
+# Write-behind saving: dirty data is flushed every SAVE_INTERVAL seconds,
+# or sooner once SAVE_THRESHOLD changes are waiting
+SAVE_INTERVAL = 5.0
+SAVE_THRESHOLD = 100
+
+# -------------- Metrics --------------
+# Per-stage latency histograms and message counters, shown by /stats
+METRICS_FILE = None # Set to e.g. os.path.join(DATA_DIR, "metrics.prom") to write Prometheus text metrics
+METRICS_INTERVAL = 15 # Seconds between metrics file writes
+metrics = Metrics("counterbot")
+
+def metric_gauges():
+    gauges = {
+        "queued_messages": sum(q.qsize() for q in dispatcher.queues.values()),
+        "active_channels": len(dispatcher.queues),
+        "saturated_channels": len(dispatcher.saturated),
+        "dropped_reposts": dispatcher.dropped_reposts,
+        "unsaved_changes": sum(data.persistence.changes for data in guild_data.values()),
+        "guilds": len(guild_data),
+        "degraded_channels": len(degraded_channels),
+        "pending_deletes": len(pending_deletes),
+        "rate_limits": send_governor.rate_limits + delete_governor.rate_limits,
+        "counters": sum(len(data.counters) for data in guild_data.values()),
+        "loop_stalls": lag_monitor.stalls,
+        "loop_lag_max_ms": round(lag_monitor.worst * 1000, 1),
+    }
+    tiered = [data.counters for data in guild_data.values() if isinstance(data.counters, TieredCounterStore)]
+    if tiered:
+        gauges["counter_tables"] = sum(len(store.tables) for store in tiered)
+        gauges["counter_cache_hits"] = sum(store.hits for store in tiered)
+        gauges["counter_cache_misses"] = sum(store.misses for store in tiered)
+        gauges["counter_cache_evictions"] = sum(store.evictions for store in tiered)
+    return gauges
+
+async def write_metrics_file():
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        text = metrics.render_prometheus(gauges=metric_gauges())
+        try:
+            await asyncio.to_thread(write_atomic, METRICS_FILE, text)
+        except OSError as e:
+            print(f"Failed to write metrics to {METRICS_FILE}: {e}")
+
+# -------------- Event Loop Lag --------------
+# A sleeping task measures how late the event loop wakes it up. Anything that holds the loop
+# (a slow callback, an expensive transform) shows up as lag, and delays gateway heartbeats too.
+LOOP_LAG_INTERVAL = 0.25 # Seconds between samples; None disables the monitor
+LOOP_LAG_WARNING = 0.1 # Seconds of lag that count as a stall and get logged
+LOOP_LAG_LOG_INTERVAL = 30 # Seconds between stall log lines; stalls in between are summarized
+
+class LoopLagMonitor:
+    def __init__(self, interval, warning, log_interval):
+        self.interval = interval
+        self.warning = warning
+        self.log_interval = log_interval
+        self.stalls = 0
+        self.worst = 0.0
+        self.unlogged = 0  # Stalls since the last log line
+        self.logged_at = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.record(loop.time() - started - self.interval)
+
+    def record(self, lag):
+        metrics.observe("loop_lag", lag)
+        self.worst = max(self.worst, lag)
+        if lag < self.warning:
+            return
+        self.stalls += 1
+        self.unlogged += 1
+        metrics.incr("loop_stalls")
+        now = time.monotonic()
+        if self.logged_at is not None and now - self.logged_at < self.log_interval:
+            return
+        earlier = f" ({self.unlogged - 1} more stall(s) since the last report)" if self.unlogged > 1 else ""
+        print(f"Event loop stalled for {lag * 1000:.0f} ms; callbacks were starved{earlier}")
+        self.logged_at = now
+        self.unlogged = 0
+
+lag_monitor = LoopLagMonitor(LOOP_LAG_INTERVAL, LOOP_LAG_WARNING, LOOP_LAG_LOG_INTERVAL)
+
+# -------------- Guild Data --------------
+class GuildData:
     """
-    Replace all mentions in text with @DisplayName, except actual reply target is handled separately.
+    One guild's settings and counters. Every guild has its own storage backend and
+    write-behind saver, so guilds load and save independently of each other.
     """
-    def repl_user(match):
-        user_id = int(match.group(1))
-        member = guild.get_member(user_id)
-        if member:
-            return f"@{member.display_name}"
-        else:
-            return f"@UnknownUser"
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.directory = os.path.join(DATA_DIR, str(guild_id))
+        os.makedirs(self.directory, exist_ok=True)
+        self.backend = open_backend(self.directory)
+        self.persistence = WriteBehind(
+            self.backend,
+            interval=SAVE_INTERVAL,
+            threshold=SAVE_THRESHOLD,
+            on_flush=lambda seconds: metrics.observe("flush", seconds),
+        )
+        self.persistence.register(TRACK_DATA, lambda: self.tracking)
+        self.persistence.register(COUNTERS_DATA, lambda: self.counters, checkpoint=lambda: self.counters.checkpoint())
+        self.persistence.register(APPEND_DATA, lambda: self.append)
+        self.persistence.register(SHORTCUT_DATA, lambda: self.shortcuts)
+        self.persistence.register(REPOST_DATA, lambda: self.repost)
+        self.persistence.register(REPLY_DATA, lambda: self.reply)
+        self.persistence.register(DELIMITER_DATA, lambda: self.delimiters)
+        self.load()
+
+    def load(self):
+        self.tracking = self.backend.load(TRACK_DATA)
+        self.counters = self.backend.load(COUNTERS_DATA)
+        self.append = self.backend.load(APPEND_DATA)
+        self.shortcuts = self.backend.load(SHORTCUT_DATA)
+        self.repost = self.backend.load(REPOST_DATA)
+        self.reply = self.backend.load(REPLY_DATA)
+        self.delimiters = self.backend.load(DELIMITER_DATA)
+        # A tiered store only holds some counters in memory, so totals come from the database
+        rows = self.counters.rows() if self.counters.complete else self.backend.counter_rows()
+        self.aggregates = Aggregates.from_rows(self.counters, rows, text_normalizer.key)
+        invalidate_guild_matchers(self.guild_id)
+
+    def mark_dirty(self, name, key=None):
+        self.persistence.mark_dirty(name, key)
+
+    # Counter changes go through these so the aggregates and saving stay in step
+    def increment_counter(self, user_id, channel_id, phrase, delta):
+        self.counters.increment(user_id, channel_id, phrase, delta)
+        self.aggregates.add(user_id, phrase, delta)
+        self.mark_dirty(COUNTERS_DATA, (user_id, channel_id, phrase))
+
+    def raise_counters(self, user_id, counts):
+        """Apply {channel_id: {phrase: count}} in one batch, only ever raising counters."""
+        raised = 0
+        for channel_id, phrases in counts.items():
+            for phrase, count in phrases.items():
+                if count > self.counters.get(user_id, channel_id, phrase):
+                    self.set_counter(user_id, channel_id, phrase, count)
+                    raised += 1
+        return raised
+
+    def set_counter(self, user_id, channel_id, phrase, count):
+        previous = self.counters.get(user_id, channel_id, phrase)
+        self.counters.set(user_id, channel_id, phrase, count)
+        self.aggregates.add(user_id, phrase, count - previous)
+        self.mark_dirty(COUNTERS_DATA, (user_id, channel_id, phrase))
+
+    async def close(self):
+        await self.persistence.stop()
+        self.backend.close()
+
+guild_data = {}  # guild_id -> GuildData
+
+def get_guild_data(guild_id):
+    data = guild_data.get(guild_id)
+    if data is None:
+        data = GuildData(guild_id)
+        guild_data[guild_id] = data
+        data.persistence.start()
+    return data
+
+async def close_all_data():
+    for data in guild_data.values():
+        await data.close()
+
+def migrate_legacy_data():
+    """
+    Data from before multi-guild support sits directly in data/. It belongs to the
+    first configured guild, so move it into that guild's directory once.
+    """
+    target = os.path.join(DATA_DIR, str(GUILD_IDS[0]))
+    if os.path.exists(target):
+        return
+    legacy = [f"{name}.json" for name in DATASETS] + [f"{COUNTERS}.journal", DATABASE_NAME, f"{DATABASE_NAME}-wal", f"{DATABASE_NAME}-shm"]
+    legacy = [name for name in legacy if os.path.exists(os.path.join(DATA_DIR, name))]
+    if not legacy:
+        return
+    os.makedirs(target)
+    for name in legacy:
+        shutil.move(os.path.join(DATA_DIR, name), os.path.join(target, name))
+    print(f"Moved existing data into {target}")
 
-    def repl_role(match):
-        role_id = int(match.group(1))
-        role = guild.get_role(role_id)
-        if role:
-            return f"@{role.name}"
-        else:
-            return "@UnknownRole"
+migrate_legacy_data()
+
+# Guild objects that slash commands are registered to
+guilds = [discord.Object(id=guild_id) for guild_id in GUILD_IDS]
+
+# -------------- Helper Functions --------------
+# Links, user mentions and role mentions in quoted text, matched in one pass
+QUOTE_ESCAPE_PATTERN = re.compile(r'(https?://\S+)|<@!?(\d+)>|<@&(\d+)>')
 
-    text = re.sub(r'<@!?(\d+)>', repl_user, text)
-    text = re.sub(r'<@&(\d+)>', repl_role, text)
-    text = text.replace('@everyone', '@everyone')
-    text = text.replace('@here', '@here')
-    return text
+def escape_quote(text: str, guild: discord.Guild) -> str:
+    """
+    Wrap links in <> to prevent embeds and replace all mentions with @DisplayName or @RoleName,
+    except actual reply target is handled separately. Each mentioned ID is looked up once.
+    """
+    names = {}
+
+    def repl(match):
+        link, user_id, role_id = match.groups()
+        if link:
+            return f"<{link}>"
+        key = user_id or "&" + role_id
+        name = names.get(key)
+        if name is None:
+            if user_id:
+                display_name = member_display_name(guild, int(user_id))
+                name = f"@{display_name}" if display_name else "@UnknownUser"
+            else:
+                role = guild.get_role(int(role_id))
+                name = f"@{role.name}" if role else "@UnknownRole"
+            names[key] = name
+        return name
+
+    return QUOTE_ESCAPE_PATTERN.sub(repl, text)
+
+# -------------- Compiled Matchers --------------
+# Each user's compiled matcher is reused for every message until one of their
+# phrase or shortcut commands changes it.
+MATCHER_CACHE_SIZE = 512 # Users kept compiled; least recently active are dropped first
+# Phrases always match across apostrophe and quote lookalikes. Optionally also match
+# compatibility forms like fullwidth letters (NFKC) and full Unicode case folding ("ß" = "ss").
+TEXT_NFKC = False
+TEXT_CASEFOLD = False
+text_normalizer = Normalizer(nfkc=TEXT_NFKC, casefold=TEXT_CASEFOLD)
+
+user_matchers = OrderedDict()  # (guild_id, user_id) -> UserMatcher
+
+def get_user_matcher(data, user_id):
+    key = (data.guild_id, user_id)
+    matcher = user_matchers.get(key)
+    if matcher is None:
+        matcher = UserMatcher(data.tracking.get(user_id, []), data.shortcuts.get(user_id, {}), text_normalizer)
+        user_matchers[key] = matcher
+        if len(user_matchers) > MATCHER_CACHE_SIZE:
+            user_matchers.popitem(last=False)
+    else:
+        user_matchers.move_to_end(key)
+    return matcher
+
+def invalidate_user_matcher(data, user_id):
+    user_matchers.pop((data.guild_id, user_id), None)
+
+def invalidate_guild_matchers(guild_id):
+    for key in [key for key in user_matchers if key[0] == guild_id]:
+        del user_matchers[key]
+    for key in [key for key in phrase_indexes if key[0] == guild_id]:
+        del phrase_indexes[key]
+
+# Each user's PhraseIndex backs the phrase commands' checks and autocomplete. The commands
+# update it in place as they change phrases and shortcuts, instead of rebuilding it.
+phrase_indexes = OrderedDict()  # (guild_id, user_id) -> PhraseIndex
+
+def get_phrase_index(data, user_id):
+    key = (data.guild_id, user_id)
+    index = phrase_indexes.get(key)
+    if index is None:
+        index = PhraseIndex(data.tracking.get(user_id, []), data.shortcuts.get(user_id, {}), text_normalizer)
+        phrase_indexes[key] = index
+        if len(phrase_indexes) > MATCHER_CACHE_SIZE:
+            phrase_indexes.popitem(last=False)
+    else:
+        phrase_indexes.move_to_end(key)
+    return index
 
 # -------------- Webhooks and Messages --------------
 # Webhook management
-channel_webhooks = {}
 WEBHOOK_NAME = "CounterBot Webhook"
+WEBHOOK_PREWARM = True # Load existing webhooks for the whole guild in one call at startup
+UNKNOWN_WEBHOOK = 10015 # Discord error code when a cached webhook was deleted
 
-async def get_channel_webhook(channel):
-    channel_id = str(channel.id)
-    webhook = channel_webhooks.get(channel_id)
-    if webhook is None:
-        webhooks = await channel.webhooks()
-        webhook = next((wh for wh in webhooks if wh.name == WEBHOOK_NAME), None)
-        if webhook is None:
-            webhook = await channel.create_webhook(name=WEBHOOK_NAME)
-        channel_webhooks[channel_id] = webhook
-    return webhook
-
-# Replace occurrences of the delimiter + display name with real mentions.
-def replace_delimiter_mentions(content, guild, delimiter="!"):
-    result = []
-    i = 0
-    n = len(content)
-
-    while i < n:
-        if content[i] != delimiter:
-            result.append(content[i])
-            i += 1
-            continue
-
-        matched = False
-        # Try every member
-        for member in guild.members:
-            for name in (member.display_name, member.name):
-                name_len = len(name)
-                # Check if there's enough characters left
-                if i + 1 + name_len > n:
+class WebhookManager:
+    """
+    One webhook per channel, created at most once even when a burst of messages arrives
+    in a new channel. Threads post through their parent channel's webhook.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.webhooks = {}  # channel_id -> webhook
+        self.locks = {}  # channel_id -> lock held while fetching or creating its webhook
+
+    async def get(self, channel):
+        webhook = self.webhooks.get(channel.id)
+        if webhook is not None:
+            return webhook
+        lock = self.locks.setdefault(channel.id, asyncio.Lock())
+        async with lock:
+            webhook = self.webhooks.get(channel.id)
+            if webhook is None:
+                webhooks = await channel.webhooks()
+                webhook = next((wh for wh in webhooks if wh.name == self.name and wh.token), None)
+                if webhook is None:
+                    webhook = await channel.create_webhook(name=self.name)
+                self.webhooks[channel.id] = webhook
+        self.locks.pop(channel.id, None)
+        return webhook
+
+    def invalidate(self, channel_id, webhook):
+        # Only evict if nobody has already replaced it
+        if self.webhooks.get(channel_id) is webhook:
+            del self.webhooks[channel_id]
+
+    async def send(self, channel, files=None, **kwargs):
+        if isinstance(channel, discord.Thread):
+            kwargs["thread"] = channel
+            channel = channel.parent
+        for attempt in range(2):
+            webhook = await self.get(channel)
+            try:
+                return await webhook.send(files=files or [], **kwargs)
+            except discord.NotFound as e:
+                # Webhook was deleted behind our back: forget it and recreate once
+                if e.code != UNKNOWN_WEBHOOK or attempt:
+                    raise
+                self.invalidate(channel.id, webhook)
+                for f in files or []:
+                    f.reset()
+
+    async def warm(self, guild):
+        """Cache every existing bot webhook in the guild with a single API call."""
+        try:
+            webhooks = await guild.webhooks()
+        except discord.HTTPException as e:
+            print(f"Failed to pre-warm webhooks: {e}")
+            return
+        for webhook in webhooks:
+            if webhook.name == self.name and webhook.token and webhook.channel_id:
+                self.webhooks.setdefault(webhook.channel_id, webhook)
+
+webhooks = WebhookManager(WEBHOOK_NAME)
+
+# Recent messages, for quoting the message a reply points to
+MESSAGE_CACHE_SIZE = 5000 # Messages remembered across all channels
+REFERENCE_FETCH_RATE = 2.0 # Reply targets fetched from the API per second, once the cache misses
+REFERENCE_FETCH_BURST = 5
+
+class MessageCache:
+    """
+    The most recent messages by ID, including our own reposts, so reply targets can be
+    quoted without an API round trip when Discord didn't resolve them. On a miss the target
+    is fetched: concurrent replies to the same message share one fetch, and fetches are
+    rate limited by a token bucket. When the bucket is empty the quote is skipped.
+    """
+    def __init__(self, size, fetch_rate, fetch_burst):
+        self.size = size
+        self.messages = OrderedDict()  # message_id -> message, least recently used first
+        self.fetching = {}  # message_id -> task fetching it
+        self.fetch_budget = TokenBucket(fetch_rate, fetch_burst)
+
+    def add(self, message):
+        self.messages[message.id] = message
+        self.messages.move_to_end(message.id)
+        if len(self.messages) > self.size:
+            self.messages.popitem(last=False)
+
+    def discard(self, message_id):
+        self.messages.pop(message_id, None)
+
+    def get(self, message_id):
+        message = self.messages.get(message_id)
+        if message is not None:
+            self.messages.move_to_end(message_id)
+        return message
+
+    async def _fetch(self, channel, message_id):
+        try:
+            message = await channel.fetch_message(message_id)
+        except discord.NotFound:
+            return None
+        except discord.HTTPException as e:
+            print(f"Failed to fetch replied message {message_id}: {e}")
+            return None
+        self.add(message)
+        return message
+
+    async def resolve(self, message):
+        """The message that message replies to, or None if it is gone or can't be fetched right now."""
+        reference = message.reference
+        if isinstance(reference.resolved, discord.Message):
+            return reference.resolved
+        # Anything else resolved means Discord says it was deleted
+        if reference.resolved is not None or reference.message_id is None:
+            return None
+        cached = self.get(reference.message_id)
+        if cached is not None:
+            metrics.incr("reply_targets_cached")
+            return cached
+        if reference.channel_id != message.channel.id:
+            return None
+        task = self.fetching.get(reference.message_id)
+        if task is None:
+            if not self.fetch_budget.try_take():
+                return None
+            metrics.incr("reply_targets_fetched")
+            task = asyncio.create_task(self._fetch(message.channel, reference.message_id))
+            self.fetching[reference.message_id] = task
+            task.add_done_callback(lambda _: self.fetching.pop(reference.message_id, None))
+        return await asyncio.shield(task)
+
+message_cache = MessageCache(MESSAGE_CACHE_SIZE, REFERENCE_FETCH_RATE, REFERENCE_FETCH_BURST)
+
+# -------------- Repost Pacing --------------
+# Client-side buckets approximating Discord's limits for executing a webhook and deleting
+# messages. When either is nearly spent for a channel, the channel goes into degraded mode:
+# counters keep updating, but reposts are skipped (or delayed) until the buckets refill.
+WEBHOOK_RATE = 2.5 # Webhook executions per second per webhook (Discord allows about 5 per 2s)
+WEBHOOK_BURST = 5
+DELETE_RATE = 5.0 # Message deletes per second per channel
+DELETE_BURST = 5
+RATE_LIMIT_COOLDOWN = 5.0 # Seconds a bucket counts as exhausted after a 429
+SLOW_REQUEST = 1.0 # discord.py waits out 429s itself; a request without files taking this long may have hit one
+SLOW_STREAK = 3 # Slow requests in a row on one bucket that count as a 429
+# "skip": degraded channels don't repost; "delay": wait for the buckets to recover, then repost
+DEGRADED_REPOSTS = "skip"
+
+send_governor = RateGovernor(WEBHOOK_RATE, WEBHOOK_BURST, cooldown=RATE_LIMIT_COOLDOWN, slow_streak=SLOW_STREAK)
+delete_governor = RateGovernor(DELETE_RATE, DELETE_BURST, cooldown=RATE_LIMIT_COOLDOWN, slow_streak=SLOW_STREAK)
+degraded_channels = set()
+pending_deletes = set()  # Delete tasks still running, so they aren't garbage collected mid-flight
+
+def webhook_key(channel):
+    # Threads post through their parent channel's webhook
+    return channel.parent_id if isinstance(channel, discord.Thread) else channel.id
+
+def repost_allowed(channel):
+    degraded = send_governor.pressured(webhook_key(channel)) or delete_governor.pressured(channel.id)
+    if degraded and channel.id not in degraded_channels:
+        degraded_channels.add(channel.id)
+        print(f"Channel {channel.id} is near its rate limits, pausing reposts")
+    elif not degraded and channel.id in degraded_channels:
+        degraded_channels.discard(channel.id)
+        print(f"Channel {channel.id} recovered, resuming reposts")
+    return not degraded
+
+async def rate_limit_gate(channel):
+    """Whether to repost in channel now; in "delay" mode, waits until it's safe to."""
+    if DEGRADED_REPOSTS == "delay":
+        while not repost_allowed(channel):
+            await asyncio.sleep(0.25)
+        return True
+    if repost_allowed(channel):
+        return True
+    metrics.incr("reposts_degraded")
+    return False
+
+def record_response(governor, key, error=None, seconds=0.0):
+    if isinstance(error, discord.RateLimited) or getattr(error, "status", None) == 429:
+        governor.rate_limited(key, getattr(error, "retry_after", 0.0))
+    elif error is None:
+        governor.responded(key, seconds > SLOW_REQUEST)
+
+async def delete_original(message):
+    started = time.perf_counter()
+    error = None
+    try:
+        await message.delete()
+    except discord.NotFound:
+        pass
+    except discord.HTTPException as e:
+        error = e
+        print(f"Failed to delete reposted message {message.id}: {e}")
+    seconds = time.perf_counter() - started
+    metrics.observe("message_delete", seconds)
+    record_response(delete_governor, message.channel.id, error, seconds)
+    message_cache.discard(message.id)
+
+def schedule_delete(message):
+    """
+    Delete a reposted original without holding up the channel: the repost already succeeded,
+    so the next message's send can overlap this delete.
+    """
+    delete_governor.spend(message.channel.id)
+    task = asyncio.create_task(delete_original(message))
+    pending_deletes.add(task)
+    task.add_done_callback(pending_deletes.discard)
+
+# -------------- Attachments --------------
+# Reposted attachments are downloaded concurrently and streamed into spooled temp files,
+# so a burst of large uploads doesn't pile up in memory
+ATTACHMENT_CONCURRENCY = 4 # Downloads in flight across all channels
+ATTACHMENT_MEMORY_BUDGET = 64 * 1024 * 1024 # Bytes of attachments held in RAM at once
+ATTACHMENT_SPOOL_SIZE = 4 * 1024 * 1024 # Attachments larger than this are spooled to disk
+ATTACHMENT_MAX_REUPLOAD = 25 * 1024 * 1024 # Larger attachments are reposted as links instead
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+
+class AttachmentFetcher:
+    def __init__(self, concurrency, memory_budget, spool_size, max_reupload):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.memory_budget = memory_budget
+        self.spool_size = spool_size
+        self.max_reupload = max_reupload
+        self.in_memory = 0
+        self.memory_freed = asyncio.Condition()
+        self.session = None
+
+    async def _reserve(self, size):
+        async with self.memory_freed:
+            # A single message bigger than the budget may still go through on its own
+            await self.memory_freed.wait_for(lambda: self.in_memory == 0 or self.in_memory + size <= self.memory_budget)
+            self.in_memory += size
+
+    async def _release(self, size):
+        async with self.memory_freed:
+            self.in_memory -= size
+            self.memory_freed.notify_all()
+
+    async def _download(self, attachment):
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        async with self.semaphore:
+            fp = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+            try:
+                async with self.session.get(attachment.url) as response:
+                    response.raise_for_status()
+                    async for chunk in response.content.iter_chunked(ATTACHMENT_CHUNK_SIZE):
+                        fp.write(chunk)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Failed to download attachment {attachment.filename}: {e}")
+                fp.close()
+                return None
+            fp.seek(0)
+            return fp
+
+    @contextlib.asynccontextmanager
+    async def fetch(self, attachments, size_limit):
+        """
+        Yield (files, links): discord.Files for attachments we re-upload, and URLs for the ones
+        that are over the size limit or failed to download. Files are closed on exit.
+        """
+        limit = min(self.max_reupload, size_limit)
+        to_fetch = [a for a in attachments if a.size <= limit]
+        links = [a.url for a in attachments if a.size > limit]
+        reserved = sum(min(a.size, self.spool_size) for a in to_fetch)
+        spools = []
+        await self._reserve(reserved)
+        try:
+            spools = await asyncio.gather(*(self._download(a) for a in to_fetch))
+            files = []
+            for attachment, fp in zip(to_fetch, spools):
+                if fp is None:
+                    links.append(attachment.url)
                     continue
-                # Case-insensitive exact match
-                if content[i+1:i+1+name_len].lower() == name.lower():
-                    result.append(member.mention)
-                    i += 1 + name_len  # advance past '!' + name
-                    matched = True
-                    break
-            if matched:
-                break
+                files.append(discord.File(
+                    fp,
+                    filename=attachment.filename,
+                    spoiler=attachment.is_spoiler(),
+                    description=attachment.description,
+                ))
+            yield files, links
+        finally:
+            for fp in spools:
+                if fp is not None:
+                    fp.close()
+            await self._release(reserved)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+attachment_fetcher = AttachmentFetcher(
+    ATTACHMENT_CONCURRENCY, ATTACHMENT_MEMORY_BUDGET, ATTACHMENT_SPOOL_SIZE, ATTACHMENT_MAX_REUPLOAD
+)
+
+# -------------- Member Name Index --------------
+# One MemberNameIndex per guild for delimiter mentions and quoted mentions.
+# With MEMBER_LOADING = "lazy" the guild isn't chunked: the index holds the members seen so
+# far (message authors, member events) plus names looked up with guild.query_members as they
+# come up after a delimiter, and mentioned IDs looked up when a quote needs their name.
+# Each lookup is remembered for MEMBER_LOOKUP_TTL seconds before it is made again. Names in
+# the index are kept until a lookup contradicts them: a lookup that returned every match
+# drops the uncached members it should have found, so renames are picked up.
+MEMBER_LOOKUP_TTL = 600
+MEMBER_LOOKUP_LIMIT = 100 # Members returned per name lookup (Discord's maximum)
+MEMBER_LOOKUP_TIMEOUT = 2.0 # Seconds a message waits for a lookup before going on without it
+MEMBER_LOOKUP_RATE = 1.0 # Lookups per second, shared by every guild (they're gateway commands)
+MEMBER_LOOKUP_BURST = 5
+# Lazy mode: the index is saved to data/<guild_id>/MEMBER_INDEX_FILE every MEMBER_INDEX_SAVE_INTERVAL
+# seconds and at shutdown, so a restart doesn't have to look everyone up again. None disables it.
+MEMBER_INDEX_FILE = "member_names.json"
+MEMBER_INDEX_SAVE_INTERVAL = 300
+MEMBER_NAME_MAX = 32 # Longest username or nickname Discord allows
+MENTION_PREFIX = re.compile(r"\w+")
+
+member_indexes = {}
+member_indexes_saved = {}  # guild_id -> index version last saved
+member_indexes_lock = asyncio.Lock()  # A save in flight finishes before the next one starts
+
+def load_member_index(guild):
+    index = MemberNameIndex()
+    path = os.path.join(get_guild_data(guild.id).directory, MEMBER_INDEX_FILE) if MEMBER_INDEX_FILE else None
+    if path and os.path.exists(path):
+        try:
+            for member_id, names in load_json(path).items():
+                # Files from before names were kept indefinitely carry a timestamp after the names
+                display_name, username = names[:2]
+                index.add_names(int(member_id), display_name, username)
+        except (OSError, ValueError) as e:
+            print(f"Failed to load member names from {path}: {e}")
+    for member in guild.members:
+        index.add(member)
+    member_indexes_saved[guild.id] = index.version
+    return index
+
+def get_member_index(guild):
+    index = member_indexes.get(guild.id)
+    if MEMBER_LOADING == "lazy":
+        if index is None:
+            index = member_indexes[guild.id] = load_member_index(guild)
+        return index
+    # Rebuild if the index was built before the member list finished chunking
+    if index is None or (not index.complete and guild.chunked):
+        index = MemberNameIndex()
+        for member in guild.members:
+            index.add(member)
+        index.complete = guild.chunked
+        member_indexes[guild.id] = index
+    return index
+
+async def save_member_indexes():
+    if MEMBER_LOADING != "lazy" or not MEMBER_INDEX_FILE:
+        return
+    async with member_indexes_lock:
+        for guild_id, index in list(member_indexes.items()):
+            version = index.version
+            if member_indexes_saved.get(guild_id) == version:
+                continue
+            path = os.path.join(get_guild_data(guild_id).directory, MEMBER_INDEX_FILE)
+            names = {str(member_id): list(names) for member_id, names in index.names.items()}
+            try:
+                await asyncio.to_thread(write_json_atomic, path, names)
+            except OSError as e:
+                print(f"Failed to save member names to {path}: {e}")
+                continue
+            member_indexes_saved[guild_id] = version
+
+async def save_member_indexes_periodically():
+    while True:
+        await asyncio.sleep(MEMBER_INDEX_SAVE_INTERVAL)
+        await save_member_indexes()
+
+def member_display_name(guild, member_id):
+    """A member's display name from the member cache or the name index, or None if unknown."""
+    member = guild.get_member(member_id)
+    if member is not None:
+        return member.display_name
+    index = member_indexes.get(guild.id)
+    names = index.names.get(member_id) if index else None
+    return names[0] if names else None
+
+class MemberLookups:
+    """
+    On-demand member lookups for lazy mode. Concurrent messages needing the same lookup share
+    one query, and queries are rate limited by a token bucket; when it's empty, names are
+    resolved from what the index already has.
+    """
+    def __init__(self, ttl, limit, timeout, rate, burst):
+        self.ttl = ttl
+        self.limit = limit
+        self.timeout = timeout
+        self.looked_up = OrderedDict()  # (guild_id, name prefix or member ID) -> (expiry, every match returned), oldest first
+        self.running = {}  # same key -> task
+        self.budget = TokenBucket(rate, burst)
+
+    def _remember(self, key, complete):
+        self.looked_up.pop(key, None)
+        now = time.monotonic()
+        self.looked_up[key] = (now + self.ttl, complete)
+        # Every entry lives for the same TTL, so the expired ones are at the front
+        while self.looked_up and next(iter(self.looked_up.values()))[0] < now:
+            self.looked_up.popitem(last=False)
+
+    def _fresh(self, key):
+        entry = self.looked_up.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self.looked_up[key]
+            return None
+        return entry
+
+    def _covered(self, guild_id, prefix):
+        # A lookup of a shorter prefix that returned every match also found all of these
+        if self._fresh((guild_id, prefix)):
+            return True
+        for end in range(1, len(prefix)):
+            entry = self._fresh((guild_id, prefix[:end]))
+            if entry and entry[1]:
+                return True
+        return False
+
+    async def _query(self, guild, keys, **query):
+        try:
+            members = await guild.query_members(limit=self.limit, cache=False, **query)
+        except (asyncio.TimeoutError, discord.HTTPException, discord.ClientException) as e:
+            print(f"Failed to look up members {query} in guild {guild.id}: {e}")
+            metrics.incr("member_lookup_failures")
+            return
+        index = get_member_index(guild)
+        for member in members:
+            index.add(member)
+        complete = len(members) < self.limit
+        if complete:
+            # Uncached members the lookup should have returned but didn't no longer have those names
+            if "user_ids" in query:
+                expected = set(query["user_ids"])
+            else:
+                prefix = query["query"]
+                expected = {
+                    member_id for member_id in index.prefixed(prefix)
+                    if any(name.lower().startswith(prefix) for name in index.names[member_id])
+                }
+            for member_id in expected - {member.id for member in members}:
+                if guild.get_member(member_id) is None:
+                    index.remove(member_id)
+        for key in keys:
+            self._remember(key, complete)
+
+    def _start(self, guild, key, keys, **query):
+        task = self.running.get(key)
+        if task is None:
+            if not self.budget.try_take():
+                metrics.incr("member_lookups_skipped")
+                return None
+            metrics.incr("member_lookups")
+            task = asyncio.create_task(self._query(guild, keys, **query))
+            self.running[key] = task
+            task.add_done_callback(lambda _: self.running.pop(key, None))
+        return task
+
+    async def _wait(self, tasks):
+        tasks = [task for task in tasks if task is not None]
+        if not tasks:
+            return
+        # A slow lookup keeps going and still fills the index, it just stops holding up this message
+        await asyncio.wait(tasks, timeout=self.timeout)
+
+    async def prepare_mentions(self, guild, content, delimiter):
+        """Look up the names that follow delimiter in content, so delimiter mentions can find them."""
+        if MEMBER_LOADING != "lazy" or delimiter not in content:
+            return
+        prefixes = set()
+        for chunk in content.split(delimiter)[1:]:
+            # Just the leading name characters, so "!bob," and "!alice's" look up "bob" and "alice".
+            # The index then picks the longest name that actually matches.
+            word = MENTION_PREFIX.match(chunk[:MEMBER_NAME_MAX])
+            if word:
+                prefixes.add(word.group(0).casefold())
+        tasks = []
+        queued = set()
+        # Shortest first: looking up "bob" also finds "bobcat"
+        for prefix in sorted(prefixes, key=len):
+            if any(prefix[:end] in queued for end in range(1, len(prefix))) or self._covered(guild.id, prefix):
+                continue
+            queued.add(prefix)
+            key = (guild.id, prefix)
+            tasks.append(self._start(guild, key, [key], query=prefix))
+        await self._wait(tasks)
+
+    async def prepare_quote(self, guild, text):
+        """Look up the members mentioned in text whose names aren't known yet, so the quote can name them."""
+        if MEMBER_LOADING != "lazy":
+            return
+        missing = set()
+        for match in QUOTE_ESCAPE_PATTERN.finditer(text):
+            if match.group(2):
+                member_id = int(match.group(2))
+                if member_display_name(guild, member_id) is None and not self._fresh((guild.id, member_id)):
+                    missing.add(member_id)
+        if not missing:
+            return
+        missing = sorted(missing)[:self.limit]
+        # IDs that don't come back aren't members, and aren't asked about again until the TTL runs out
+        task = self._start(guild, (guild.id, tuple(missing)), [(guild.id, member_id) for member_id in missing], user_ids=missing)
+        await self._wait([task])
+
+member_lookups = MemberLookups(MEMBER_LOOKUP_TTL, MEMBER_LOOKUP_LIMIT, MEMBER_LOOKUP_TIMEOUT, MEMBER_LOOKUP_RATE, MEMBER_LOOKUP_BURST)
+
+# Keep the member name indexes current
+@bot.event
+async def on_member_join(member):
+    index = member_indexes.get(member.guild.id)
+    if index:
+        index.add(member)
 
-        if not matched:
-            # No match → keep the delimiter as-is
-            result.append(content[i])
-            i += 1
+@bot.event
+async def on_member_update(before, after):
+    index = member_indexes.get(after.guild.id)
+    if index and (before.display_name != after.display_name or before.name != after.name):
+        index.add(after)
 
-    return "".join(result)
+@bot.event
+async def on_raw_member_remove(payload):
+    # Raw, because in lazy mode most members aren't in the member cache
+    index = member_indexes.get(payload.guild_id)
+    if index:
+        index.remove(payload.user.id)
+
+@bot.event
+async def on_user_update(before, after):
+    # Username and global display name changes are user-level, not per-member
+    if before.name == after.name and before.display_name == after.display_name:
+        return
+    for g in bot.guilds:
+        index = member_indexes.get(g.id)
+        member = g.get_member(after.id)
+        if index and member:
+            index.add(member)
+
+# -------------- Transform Offload --------------
+# The regex work of an expensive message runs on a worker instead of the event loop, so one
+# long message from a user with many phrases and shortcuts can't stall every other event.
+# "thread": a thread pool. Regexes still hold the GIL, but the loop gets it back every few
+#   milliseconds instead of waiting out the whole transform.
+# "process": a process pool, for real parallelism. The matcher is pickled with every message,
+#   and workers are forked, so this needs a platform with fork.
+# None: everything runs on the event loop
+TRANSFORM_OFFLOAD = "thread"
+TRANSFORM_WORKERS = 2
+# Estimated cost above which a transform is offloaded: message length times the number of
+# pattern alternatives (tracked phrases + shortcuts) tried at each position. Around 1ms.
+TRANSFORM_OFFLOAD_COST = 250_000
+
+def make_transform_executor():
+    if TRANSFORM_OFFLOAD == "process":
+        # Forked, not spawned: a spawned worker would re-run this module's startup code
+        return ProcessPoolExecutor(TRANSFORM_WORKERS, mp_context=multiprocessing.get_context("fork"))
+    if TRANSFORM_OFFLOAD == "thread":
+        return ThreadPoolExecutor(TRANSFORM_WORKERS, thread_name_prefix="transform")
+    return None
+
+transform_executor = make_transform_executor()
+
+def transform_cost(content, matcher):
+    return len(content) * (1 + len(matcher.phrase_list) + len(matcher.shortcuts))
+
+async def run_transform(content, matcher, counters, append_phrase=None, delimiter=None, member_index=None, stage_times=None):
+    """transform_message, run on transform_executor when the message is expensive enough."""
+    if transform_executor is None or transform_cost(content or "", matcher) < TRANSFORM_OFFLOAD_COST:
+        return transform_message(
+            content, matcher, counters,
+            append_phrase=append_phrase, delimiter=delimiter, member_index=member_index, stage_times=stage_times,
+        )
+    # Member events update the name index on the loop, so mentions are resolved here, not in a worker
+    mentioned = False
+    if delimiter and member_index is not None:
+        started = time.perf_counter()
+        replaced = replace_delimiter_mentions(content, member_index, delimiter=delimiter)
+        mentioned = replaced != content
+        content = replaced
+        if stage_times is not None:
+            stage_times["delimiter"] = time.perf_counter() - started
+    metrics.incr("transforms_offloaded")
+    (modified, deltas, updated), worker_times = await asyncio.get_running_loop().run_in_executor(
+        transform_executor, functools.partial(timed_transform, content, matcher, counters, append_phrase=append_phrase)
+    )
+    if stage_times is not None:
+        for stage, seconds in worker_times.items():
+            stage_times[stage] = stage_times.get(stage, 0.0) + seconds
+    return modified, deltas, updated or mentioned
+
+# -------------- Message Dispatch --------------
+# Messages are processed by one worker per channel, in arrival order, so two quick messages
+# in the same channel can't interleave their reposts or counter updates. Different channels
+# run in parallel.
+CHANNEL_QUEUE_SIZE = 50 # Messages waiting per channel before the overflow policy applies
+# "drop_repost": when a channel's queue is full, count the message right away but skip its repost
+# "block": wait for room in the queue
+QUEUE_OVERFLOW = "drop_repost"
+CHANNEL_WORKER_IDLE = 60 # Seconds a channel worker waits for messages before exiting
+SHUTDOWN_DRAIN_TIMEOUT = 10 # Seconds shutdown waits for queued messages to be processed
+
+class ChannelDispatcher:
+    def __init__(self, handler, maxsize, overflow, idle_timeout):
+        self.handler = handler
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.idle_timeout = idle_timeout
+        self.queues = {}
+        self.workers = {}  # channel_id -> worker task, so it isn't garbage collected mid-flight
+        self.high_water = {}  # channel_id -> deepest queue seen
+        self.saturated = set()
+        self.dropped_reposts = 0
+
+    async def submit(self, message):
+        channel_id = message.channel.id
+        queue = self.queues.get(channel_id)
+        if queue is None:
+            queue = asyncio.Queue(maxsize=self.maxsize)
+            self.queues[channel_id] = queue
+            self.workers[channel_id] = asyncio.create_task(self._worker(channel_id, queue))
+
+        if queue.full():
+            if channel_id not in self.saturated:
+                self.saturated.add(channel_id)
+                print(f"Channel {channel_id} queue is saturated ({queue.qsize()} waiting)")
+            if self.overflow == "drop_repost":
+                self.dropped_reposts += 1
+                await self.handler(message, allow_repost=False)
+                return
+
+        await queue.put(message)
+        self.high_water[channel_id] = max(self.high_water.get(channel_id, 0), queue.qsize())
+
+    async def _worker(self, channel_id, queue):
+        while True:
+            try:
+                message = await asyncio.wait_for(queue.get(), timeout=self.idle_timeout)
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    del self.queues[channel_id]
+                    del self.workers[channel_id]
+                    self.saturated.discard(channel_id)
+                    return
+                continue
+            if queue.empty():
+                self.saturated.discard(channel_id)
+            try:
+                await self.handler(message)
+            except Exception as e:
+                print(f"Failed to process message {message.id} in channel {channel_id}: {e}")
+            finally:
+                queue.task_done()
+
+    async def drain(self, timeout):
+        """Process the messages already queued, for up to timeout seconds, then stop every worker."""
+        if self.queues:
+            joins = [asyncio.create_task(queue.join()) for queue in self.queues.values()]
+            _, pending = await asyncio.wait(joins, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                waiting = sum(queue.qsize() for queue in self.queues.values())
+                print(f"Shutting down with {waiting} queued messages not processed")
+        workers = list(self.workers.values())
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    def depths(self):
+        """Current queue depth per channel, deepest first."""
+        return sorted(((cid, q.qsize()) for cid, q in self.queues.items()), key=lambda d: d[1], reverse=True)
 
 # Message handling
 @bot.event
 async def on_message(message):
+    # Only handle guilds this deployment is configured for
+    if message.guild is None or message.guild.id not in GUILD_IDS:
+        return
+    # Remember every message, our own webhook reposts included, in case someone replies to it
+    message_cache.add(message)
     # Ignore messages sent by other bots (including itself) to prevent loops or double processing
     if message.author.bot:
         return
+    if MEMBER_LOADING == "lazy" and isinstance(message.author, discord.Member):
+        get_member_index(message.guild).add(message.author)
+    await dispatcher.submit(message)
+
+@bot.event
+async def on_raw_message_delete(payload):
+    message_cache.discard(payload.message_id)
+
+async def process_message(message, allow_repost=True):
+    started = time.perf_counter()
+    metrics.incr("messages_processed")
 
     # If message has attachments but no text, skip because there's nothing to track/append
     if not message.content.strip() and message.attachments:
+        metrics.incr("messages_skipped")
         await bot.process_commands(message)
         return
 
     # Skip any message that isn't a default or reply type
     if message.type != discord.MessageType.default and message.type != discord.MessageType.reply:
+        metrics.incr("messages_skipped")
         return
     
     # Skip empty messages (like forwarded messages, which have no message content)
     if not message.content and not message.attachments:
+        metrics.incr("messages_skipped")
         return
 
     # User information
+    data = get_guild_data(message.guild.id)
     user_id = str(message.author.id)
     channel_id = str(message.channel.id)
-    repost_enabled = repost_data.get(user_id, True)
-    user_phrases = tracking_data.get(user_id, [])
-    append_phrase = append_data.get(user_id)
-    user_shortcuts = shortcuts_data.get(user_id, {})
-    modified = normalize_apostrophes(message.content or "") # Handle different cases of apostrophes
-    updated = False
-    skip_append = False
-
-    # Apply delimiter-based mention replacement to modified message
-    user_delimiter = delimiters_data.get(user_id)
+    repost_enabled = data.repost.get(user_id, True)
+    append_phrase = data.append.get(user_id)
+    user_delimiter = data.delimiters.get(user_id)
+    member_index = None
     if user_delimiter:
-        new_modified = replace_delimiter_mentions(
-            modified,
-            message.guild,
-            delimiter=user_delimiter
-        )
-        if new_modified != modified:
-            modified = new_modified
-            updated = True
-
-    # Initialize counters
-    if user_id not in counters_data:
-        counters_data[user_id] = {}
-    if channel_id not in counters_data[user_id]:
-        counters_data[user_id][channel_id] = {}
-
-    # Helper: Check if phrase at start or end
-    def phrase_at_edges(msg, phrase):
-        import string
-        import re
-
-        # Normalize apostrophes
-        msg = normalize_apostrophes(msg)
-        phrase = normalize_apostrophes(phrase)
-
-        # Remove tracked phrase counters like " X123"
-        msg_clean = re.sub(r' X\d+', '', msg).strip()
-
-        # Strip only standard whitespace and punctuation, keep emojis and other Unicode chars
-        msg_clean = msg_clean.strip(string.whitespace + string.punctuation)
-
-        # Case-insensitive check for phrase at start or end
-        starts = msg_clean.lower().startswith(phrase.lower())
-        ends = msg_clean.lower().endswith(phrase.lower())
-
-        return starts or ends
-
-    # If shortcut expansion resulted in exactly the append phrase, skip appending
-    if append_phrase and modified:
-        def normalize_for_compare(s: str) -> str:
-            s = normalize_apostrophes(s)
-            s = re.sub(r' X\d+', '', s)      # remove counters
-            s = re.sub(r'[.!?,;:]+$', '', s) # strip trailing punctuation
-            return s.strip().lower()
-
-        if normalize_for_compare(modified) == normalize_for_compare(append_phrase):
-            skip_append = True
-
-    # Apply shortcuts
-    if modified:
-        for shortcut, target_phrase in user_shortcuts.items():
-            pattern = r'\b' + re.escape(shortcut) + r'\b'
-
-            def replace_func(match):
-                nonlocal skip_append
-                # If shortcut occurs at the start (ignoring leading punctuation/whitespace)
-                prefix = modified[:match.start()]
-                if not prefix.strip(string.punctuation + string.whitespace):
-                    skip_append = True
-                return target_phrase
-
-            new_modified = re.sub(pattern, replace_func, modified, flags=re.IGNORECASE)
-            if new_modified != modified:
-                modified = new_modified
-                updated = True
-
-    # Remove existing counters like "phrase X123"
-    if modified:
-        for phrase in user_phrases:
-            # Match cases like "RIP X172" or ":thumbsup: X5"
-            norm_phrase = normalize_apostrophes(phrase)
-            pattern = rf'(?<!\w)({re.escape(norm_phrase)})\s*X\d+'
-            modified = re.sub(pattern, r'\1', modified, flags=re.IGNORECASE)
-
-    # Apply tracked phrase counters
-    if modified:
-        for phrase in user_phrases:
-            norm_phrase = normalize_apostrophes(phrase)
-            pattern = r'(?<!\w)(' + re.escape(norm_phrase) + r')(?!\w)'
-            matches = list(re.finditer(pattern, modified, flags=re.IGNORECASE))
-            if not matches:
-                continue
-            offset = 0
-            for match in matches:
-                start, end = match.span()
-                start += offset
-                end += offset
-                current_count = counters_data[user_id][channel_id].get(phrase, 0) + 1
-                counters_data[user_id][channel_id][phrase] = current_count
-                insert_text = f" X{current_count}"
-                modified = modified[:end] + insert_text + modified[end:]
-                offset += len(insert_text)
-                updated = True
-
-    # Apply append phrase
-    if append_phrase and not skip_append:
-        content_to_check = modified.strip()
-        # Skip if fully enclosed
-        if not ((content_to_check.startswith('(') and content_to_check.endswith(')')) or
-                (content_to_check.startswith('{') and content_to_check.endswith('}')) or
-                (content_to_check.startswith('[') and content_to_check.endswith(']'))):
-            # Skip if any tracked phrase is at start or end
-            if not any(phrase_at_edges(content_to_check, p) for p in user_phrases):
-                if append_phrase in user_phrases:
-                    append_count = counters_data[user_id][channel_id].get(append_phrase, 0) + 1
-                    counters_data[user_id][channel_id][append_phrase] = append_count
-                    append_text = f"{append_phrase} X{append_count}"
-                else:
-                    append_text = append_phrase
-
-                m = re.search(r'([.!?]+)$', content_to_check)
-                if m:
-                    punct = m.group(1)
-                    core = content_to_check[:-len(punct)]
-                else:
-                    core = content_to_check
-                    punct = ''
-                modified = f"{core}, {append_text}{punct}"
-                updated = True
-
-    # Delete/repost only if enabled
-    if updated:
-        save_json(COUNTERS_FILE, counters_data)
+        await member_lookups.prepare_mentions(message.guild, message.content, user_delimiter)
+        member_index = get_member_index(message.guild)
+
+    channel_counters = data.counters.channel(user_id, channel_id)
+
+    stage_times = {}
+    modified, deltas, updated = await run_transform(
+        message.content,
+        get_user_matcher(data, user_id),
+        channel_counters,
+        append_phrase=append_phrase,
+        delimiter=user_delimiter,
+        member_index=member_index,
+        stage_times=stage_times,
+    )
+    for stage, seconds in stage_times.items():
+        metrics.observe(stage, seconds)
 
-        # Gather attachments from current message
-        files = [await att.to_file() for att in message.attachments]
+    with metrics.time("persistence"):
+        for phrase, delta in deltas.items():
+            data.increment_counter(user_id, channel_id, phrase, delta)
 
+    # Delete/repost only if enabled
+    if updated and repost_enabled and allow_repost and await rate_limit_gate(message.channel):
         # Check if reply quoting is enabled
-        user_reply_enabled = reply_data.get(user_id, False)  # default False
+        user_reply_enabled = data.reply.get(user_id, False)  # default False
         reply_prefix = ""
 
-        if user_reply_enabled and message.reference and isinstance(message.reference.resolved, discord.Message):
-            original = message.reference.resolved
+        original = await message_cache.resolve(message) if user_reply_enabled and message.reference else None
+        if user_reply_enabled and message.reference and original is None:
+            metrics.incr("reply_targets_unresolved")
+        if original is not None:
             original_lines = original.content.splitlines()
 
             # Skip bot-generated quotes to avoid double quoting
@@ -346,143 +1133,288 @@ async def on_message(message):
                 clean_lines = original_lines
 
             if clean_lines:
-                # Escape URLs in the quote to prevent embeds
-                def escape_links(line):
-                    # Wrap any http(s) links in <>
-                    return re.sub(r'(https?://\S+)', r'<\1>', line)
-
-                quoted_lines = "\n".join(
-                    f"> {escape_mentions(escape_links(line), message.guild)}"
-                    for line in clean_lines
-                )
+                # Escape the whole quote at once, then prefix each line
+                quoted = "\n".join(clean_lines)
+                await member_lookups.prepare_quote(message.guild, quoted)
+                quoted_lines = "\n".join(f"> {line}" for line in escape_quote(quoted, message.guild).split("\n"))
                 reply_prefix = f"> {original.author.mention}\n{quoted_lines}\n"
 
-        if repost_enabled:
+        # Gather attachments from current message
+        fetch_started = time.perf_counter()
+        async with attachment_fetcher.fetch(message.attachments, message.guild.filesize_limit) as (files, links):
+            if message.attachments:
+                metrics.observe("attachments", time.perf_counter() - fetch_started)
+            content = reply_prefix + modified
+            if links:
+                content += "\n" + "\n".join(links)
+            send_governor.spend(webhook_key(message.channel))
+            send_started = time.perf_counter()
             try:
-                webhook = await get_channel_webhook(message.channel)
-                await webhook.send(
-                    content=reply_prefix + modified,
+                repost = await webhooks.send(
+                    message.channel,
+                    content=content,
                     username=message.author.display_name,
                     avatar_url=message.author.display_avatar.url,
                     wait=True,
                     files=files
                 )
-
-                await message.delete()
             except Exception as e:
+                record_response(send_governor, webhook_key(message.channel), e)
+                metrics.incr("repost_failures")
                 print(f"Failed to repost message from {message.author}: {e}")
+            else:
+                seconds = time.perf_counter() - send_started
+                metrics.observe("webhook_send", seconds)
+                # Uploads can legitimately take a while, so only plain sends are judged by their duration
+                record_response(send_governor, webhook_key(message.channel), seconds=0.0 if files else seconds)
+                if repost is not None:
+                    message_cache.add(repost)
+                schedule_delete(message)
+                metrics.incr("messages_reposted")
+        metrics.observe("total", time.perf_counter() - started)
+    else:
+        metrics.incr("messages_skipped")
 
     await bot.process_commands(message)
-   
+
+dispatcher = ChannelDispatcher(process_message, CHANNEL_QUEUE_SIZE, QUEUE_OVERFLOW, CHANNEL_WORKER_IDLE)
+
+# -------------- Recount --------------
+# /recount rebuilds a user's counters from channel history with the same rules as on_message
+RECOUNT_PAGE_SIZE = 100 # Messages per history request (Discord's maximum)
+RECOUNT_CONCURRENCY = 3 # Channels scanned at once
+RECOUNT_PAGE_RATE = 2.0 # History requests per second, shared by every recount
+RECOUNT_CHECKPOINT_PAGES = 10 # Save progress every this many pages per channel
+
+recount_budget = TokenBucket(RECOUNT_PAGE_RATE, RECOUNT_CONCURRENCY)
+recount_slots = asyncio.Semaphore(RECOUNT_CONCURRENCY)
+recounts = {}  # (guild_id, user_id) -> running Recount
+
+def strip_reply_quote(content):
+    # Reposted replies start with "> <@user>" and the quoted lines, which aren't the author's words
+    lines = content.splitlines()
+    if not lines or not re.match(r"^> <@!?\d+>", lines[0]):
+        return content
+    while lines and lines[0].startswith("> "):
+        lines.pop(0)
+    return "\n".join(lines)
+
+class Recount:
+    """
+    Rebuilds one user's counters from the history of the given channels: their own messages,
+    plus our webhook reposts under their current display name or username. Counts are
+    collected per channel and applied in one batch at the end. Progress is checkpointed to
+    the guild's directory, so an interrupted recount resumes the next time it's run.
+    """
+    def __init__(self, data, member, channels):
+        self.data = data
+        self.user_id = str(member.id)
+        self.member_id = member.id
+        self.names = {member.display_name, member.name}
+        self.path = os.path.join(data.directory, f"recount-{self.user_id}.json")
+        # after: channel_id -> last message scanned; counts: channel_id -> {phrase: count}
+        self.state = {"after": {}, "counts": {}, "done": []}
+        if os.path.exists(self.path):
+            self.state = load_json(self.path)
+        self.resumed = bool(self.state["after"])
+        self.channels = [c for c in channels if str(c.id) not in self.state["done"]]
+        self.scanned = 0
+        self.lock = asyncio.Lock()
+
+    async def checkpoint(self):
+        # Serialized on the event loop so the channel tasks can't change it mid-write
+        text = dump_json(self.state)
+        async with self.lock:
+            await asyncio.to_thread(write_atomic, self.path, text)
+
+    async def deltas(self, message, matcher, append_phrase):
+        if message.type != discord.MessageType.default and message.type != discord.MessageType.reply:
+            return None
+        if message.author.id == self.member_id:
+            content = message.content
+        elif message.webhook_id is not None and message.author.name in self.names:
+            # Reposts already carry the append phrase and expanded shortcuts
+            content = strip_reply_quote(message.content)
+            append_phrase = None
+        else:
+            return None
+        _, deltas, _ = await run_transform(content, matcher, {}, append_phrase=append_phrase)
+        return deltas
+
+    async def scan(self, channel, matcher, append_phrase):
+        channel_id = str(channel.id)
+        counts = self.state["counts"].setdefault(channel_id, {})
+        pages = 0
+        async with recount_slots:
+            while True:
+                after = self.state["after"].get(channel_id)
+                await recount_budget.take()
+                try:
+                    page = [message async for message in channel.history(
+                        limit=RECOUNT_PAGE_SIZE,
+                        after=discord.Object(id=after) if after else None,
+                        oldest_first=True,
+                    )]
+                except discord.Forbidden:
+                    break
+                for message in page:
+                    deltas = await self.deltas(message, matcher, append_phrase)
+                    for phrase, delta in (deltas or {}).items():
+                        counts[phrase] = counts.get(phrase, 0) + delta
+                self.scanned += len(page)
+                if page:
+                    self.state["after"][channel_id] = page[-1].id
+                pages += 1
+                if len(page) < RECOUNT_PAGE_SIZE:
+                    break
+                if pages % RECOUNT_CHECKPOINT_PAGES == 0:
+                    await self.checkpoint()
+        self.state["done"].append(channel_id)
+        await self.checkpoint()
+
+    async def run(self):
+        """Scan every channel, apply the counts, and return how many counters were raised."""
+        matcher = get_user_matcher(self.data, self.user_id)
+        append_phrase = self.data.append.get(self.user_id)
+        # Let every channel reach a checkpoint before giving up on the first error
+        results = await asyncio.gather(*(self.scan(channel, matcher, append_phrase) for channel in self.channels), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        raised = self.data.raise_counters(self.user_id, self.state["counts"])
+        await self.data.persistence.flush_async()
+        os.remove(self.path)
+        return raised
+
 # -------------- Commands --------------
 # /track
-@bot.tree.command(name="track", description="Track a phrase", guild=guild)
+@bot.tree.command(name="track", description="Track a phrase", guilds=guilds)
 @app_commands.describe(phrase="The phrase you want to track")
 async def track(interaction: discord.Interaction, phrase: str):
+    phrase = normalize_lookalikes(phrase)
     user_id = str(interaction.user.id)
-    if user_id not in tracking_data:
-        tracking_data[user_id] = []
-    if phrase.lower() in [p.lower() for p in tracking_data[user_id]]:
+    data = get_guild_data(interaction.guild_id)
+    index = get_phrase_index(data, user_id)
+    if index.tracked(phrase) is not None:
         await interaction.response.send_message(f"You are already tracking '{phrase}'!", ephemeral=True)
         return
-    tracking_data[user_id].append(phrase)
-    save_json(TRACK_FILE, tracking_data)
+    data.tracking.setdefault(user_id, []).append(phrase)
+    index.add_phrase(phrase)
+    invalidate_user_matcher(data, user_id)
+    data.mark_dirty(TRACK_DATA, user_id)
     await interaction.response.send_message(f"You are now tracking: '{phrase}'", ephemeral=True)
     
 # /untrack
-@bot.tree.command(name="untrack", description="Stop tracking a phrase", guild=guild)
+@bot.tree.command(name="untrack", description="Stop tracking a phrase", guilds=guilds)
 @app_commands.describe(phrase="The phrase you want to stop tracking")
 async def untrack(interaction: discord.Interaction, phrase: str):
+    phrase = normalize_lookalikes(phrase)
     user_id = str(interaction.user.id)
-    if user_id not in tracking_data:
+    data = get_guild_data(interaction.guild_id)
+    if user_id not in data.tracking:
         await interaction.response.send_message("You are not tracking any phrases!", ephemeral=True)
         return
-    matched = next((p for p in tracking_data[user_id] if p.lower() == phrase.lower()), None)
-    if not matched:
+    index = get_phrase_index(data, user_id)
+    matched = index.tracked(phrase)
+    if matched is None:
         await interaction.response.send_message(f"You are not tracking '{phrase}'!", ephemeral=True)
         return
-    tracking_data[user_id].remove(matched)
-    if not tracking_data[user_id]:
-        del tracking_data[user_id]
-    save_json(TRACK_FILE, tracking_data)
+    data.tracking[user_id].remove(matched)
+    index.remove_phrase(matched)
+    if not data.tracking[user_id]:
+        del data.tracking[user_id]
+    invalidate_user_matcher(data, user_id)
+    data.mark_dirty(TRACK_DATA, user_id)
     await interaction.response.send_message(f"You have stopped tracking: '{phrase}'", ephemeral=True)
     
 # /set
-@bot.tree.command(name="set", description="Set the counter for a tracked phrase", guild=guild)
+@bot.tree.command(name="set", description="Set the counter for a tracked phrase", guilds=guilds)
 @app_commands.describe(phrase="The phrase", count="Set counter to this number (≥0)")
 async def set_counter(interaction: discord.Interaction, phrase: str, count: int):
+    phrase = normalize_lookalikes(phrase)
     if count < 0:
         await interaction.response.send_message("Counter cannot be negative.", ephemeral=True)
         return
     user_id = str(interaction.user.id)
+    data = get_guild_data(interaction.guild_id)
+    tracked = get_phrase_index(data, user_id).tracked(phrase)
+    if tracked is None:
+        await interaction.response.send_message(f"You are not tracking '{phrase}'!", ephemeral=True)
+        return
     channel_id = str(interaction.channel.id)
-    if user_id not in counters_data:
-        counters_data[user_id] = {}
-    if channel_id not in counters_data[user_id]:
-        counters_data[user_id][channel_id] = {}
-    counters_data[user_id][channel_id][phrase] = count
-    save_json(COUNTERS_FILE, counters_data)
-    await interaction.response.send_message(f"Counter for '{phrase}' set to {count}.", ephemeral=True)
+    data.set_counter(user_id, channel_id, tracked, count)
+    await interaction.response.send_message(f"Counter for '{tracked}' set to {count}.", ephemeral=True)
     
 # /append
-@bot.tree.command(name="append", description="Append a phrase to your messages", guild=guild)
+@bot.tree.command(name="append", description="Append a phrase to your messages", guilds=guilds)
 @app_commands.describe(phrase="Phrase to append (leave empty to remove)")
 async def append_command(interaction: discord.Interaction, phrase: str = None):
     user_id = str(interaction.user.id)
+    data = get_guild_data(interaction.guild_id)
     if not phrase or phrase.strip() == "":
-        if user_id in append_data:
-            del append_data[user_id]
-            save_json(APPEND_FILE, append_data)
+        if user_id in data.append:
+            del data.append[user_id]
+            data.mark_dirty(APPEND_DATA, user_id)
             await interaction.response.send_message("Removed append phrase.", ephemeral=True)
         else:
             await interaction.response.send_message("You don't have an append phrase set.", ephemeral=True)
         return
-    append_data[user_id] = phrase
-    save_json(APPEND_FILE, append_data)
+    data.append[user_id] = normalize_lookalikes(phrase)
+    data.mark_dirty(APPEND_DATA, user_id)
     await interaction.response.send_message(f"Messages will now append '{phrase}'.", ephemeral=True)
     
 # /shortcut_add
-@bot.tree.command(name="shortcut_add", description="Add a shortcut for a phrase", guild=guild)
+@bot.tree.command(name="shortcut_add", description="Add a shortcut for a phrase", guilds=guilds)
 @app_commands.describe(phrase="Phrase to replace with", shortcut="Shortcut trigger word")
 async def shortcut_add(interaction: discord.Interaction, phrase: str, shortcut: str):
+    phrase = normalize_lookalikes(phrase)
+    shortcut = normalize_lookalikes(shortcut)
     user_id = str(interaction.user.id)
-    if user_id not in shortcuts_data:
-        shortcuts_data[user_id] = {}
-    if any(s.lower() == shortcut.lower() for s in shortcuts_data[user_id]):
+    data = get_guild_data(interaction.guild_id)
+    index = get_phrase_index(data, user_id)
+    if index.has_shortcut(shortcut):
         await interaction.response.send_message(f"Shortcut '{shortcut}' already exists.", ephemeral=True)
         return
-    shortcuts_data[user_id][shortcut] = phrase
-    save_json(SHORTCUT_FILE, shortcuts_data)
+    data.shortcuts.setdefault(user_id, {})[shortcut] = phrase
+    index.add_shortcut(shortcut, phrase)
+    invalidate_user_matcher(data, user_id)
+    data.mark_dirty(SHORTCUT_DATA, user_id)
     await interaction.response.send_message(f"Shortcut '{shortcut}' → '{phrase}' added.", ephemeral=True)
     
 # /shortcut_remove
-@bot.tree.command(name="shortcut_remove", description="Remove a shortcut for a phrase", guild=guild)
+@bot.tree.command(name="shortcut_remove", description="Remove a shortcut for a phrase", guilds=guilds)
 @app_commands.describe(phrase="Phrase whose shortcut to remove")
 async def shortcut_remove(interaction: discord.Interaction, phrase: str):
+    phrase = normalize_lookalikes(phrase)
     user_id = str(interaction.user.id)
-    if user_id not in shortcuts_data:
+    data = get_guild_data(interaction.guild_id)
+    if user_id not in data.shortcuts:
         await interaction.response.send_message("You don't have any shortcuts.", ephemeral=True)
         return
-    to_remove = [s for s, p in shortcuts_data[user_id].items() if p.lower() == phrase.lower()]
+    index = get_phrase_index(data, user_id)
+    to_remove = index.shortcuts_for(phrase)
     if not to_remove:
         await interaction.response.send_message(f"No shortcut found for '{phrase}'.", ephemeral=True)
         return
     for s in to_remove:
-        del shortcuts_data[user_id][s]
-    save_json(SHORTCUT_FILE, shortcuts_data)
+        del data.shortcuts[user_id][s]
+        index.remove_shortcut(s)
+    invalidate_user_matcher(data, user_id)
+    data.mark_dirty(SHORTCUT_DATA, user_id)
     await interaction.response.send_message(f"Removed shortcut(s): {', '.join(to_remove)}", ephemeral=True)
 
 # /delimiter
-@bot.tree.command(name="delimiter", description="Set your mention delimiter", guild=guild)
+@bot.tree.command(name="delimiter", description="Set your mention delimiter", guilds=guilds)
 @app_commands.describe(delimiter="Single character to use as mention prefix")
 async def set_delimiter(interaction: discord.Interaction, delimiter: str = None):
     user_id = str(interaction.user.id)
+    data = get_guild_data(interaction.guild_id)
     
     # If user provided nothing or only whitespace, disable the delimiter
     if not delimiter or delimiter.strip() == "":
-        if user_id in delimiters_data:
-            del delimiters_data[user_id]
-            save_json(DELIMITER_FILE, delimiters_data)
+        if user_id in data.delimiters:
+            del data.delimiters[user_id]
+            data.mark_dirty(DELIMITER_DATA, user_id)
         await interaction.response.send_message(
             "Your mention delimiter is now disabled.", ephemeral=True
         )
@@ -495,14 +1427,14 @@ async def set_delimiter(interaction: discord.Interaction, delimiter: str = None)
         )
         return
 
-    delimiters_data[user_id] = delimiter
-    save_json(DELIMITER_FILE, delimiters_data)
+    data.delimiters[user_id] = delimiter
+    data.mark_dirty(DELIMITER_DATA, user_id)
     await interaction.response.send_message(
         f"Your mention delimiter is now set to `{delimiter}`.", ephemeral=True
     )
 
 # /repost
-@bot.tree.command(name="repost", description="Toggle message reposting on or off", guild=guild)
+@bot.tree.command(name="repost", description="Toggle message reposting on or off", guilds=guilds)
 @app_commands.describe(toggle="Enable or disable reposting (on/off)")
 async def repost_command(interaction: discord.Interaction, toggle: str):
     toggle = toggle.lower()
@@ -510,8 +1442,9 @@ async def repost_command(interaction: discord.Interaction, toggle: str):
         await interaction.response.send_message("Invalid argument. Use `on` or `off`.", ephemeral=True)
         return
     user_id = str(interaction.user.id)
-    repost_data[user_id] = toggle == "on"
-    save_json(REPOST_FILE, repost_data)
+    data = get_guild_data(interaction.guild_id)
+    data.repost[user_id] = toggle == "on"
+    data.mark_dirty(REPOST_DATA, user_id)
     status = "enabled" if toggle == "on" else "disabled"
     await interaction.response.send_message(f"Reposting is now {status}.", ephemeral=True)
 
@@ -519,7 +1452,7 @@ async def repost_command(interaction: discord.Interaction, toggle: str):
 @bot.tree.command(
     name="reply",
     description="Toggle the new reply quoting mechanic on or off",
-    guild=guild
+    guilds=guilds
 )
 @app_commands.describe(toggle="Enable or disable reply quoting (on/off)")
 async def reply(interaction: discord.Interaction, toggle: str):
@@ -532,8 +1465,10 @@ async def reply(interaction: discord.Interaction, toggle: str):
         return
 
     user_id = str(interaction.user.id)
-    reply_data[user_id] = toggle == "on"
-    save_reply()
+
+    data = get_guild_data(interaction.guild_id)
+    data.reply[user_id] = toggle == "on"
+    data.mark_dirty(REPLY_DATA, user_id)
 
     status = "enabled" if toggle == "on" else "disabled"
     await interaction.response.send_message(
@@ -542,22 +1477,23 @@ async def reply(interaction: discord.Interaction, toggle: str):
     )
 
 # /list
-@bot.tree.command(name="list", description="List tracked phrases, counters, shortcuts, and append phrase", guild=guild)
+@bot.tree.command(name="list", description="List tracked phrases, counters, shortcuts, and append phrase", guilds=guilds)
 async def list_command(interaction: discord.Interaction):
     user_id = str(interaction.user.id)
+    data = get_guild_data(interaction.guild_id)
     channel_id = str(interaction.channel.id)
     embed = discord.Embed(title=f"{interaction.user.display_name}'s Tracking Info", color=discord.Color.blue())
 
     # Tracked phrases and counters
-    user_phrases = tracking_data.get(user_id, [])
+    user_phrases = data.tracking.get(user_id, [])
     if user_phrases:
-        phrase_lines = [f"`{p}` X{counters_data.get(user_id, {}).get(channel_id, {}).get(p, 0)}" for p in user_phrases]
+        phrase_lines = [f"`{p}` X{data.counters.get(user_id, channel_id, p)}" for p in user_phrases]
         embed.add_field(name="Tracked Phrases", value="\n".join(phrase_lines), inline=False)
     else:
         embed.add_field(name="Tracked Phrases", value="You are not tracking any phrases.", inline=False)
 
     # Shortcuts
-    user_shortcuts = shortcuts_data.get(user_id, {})
+    user_shortcuts = data.shortcuts.get(user_id, {})
     if user_shortcuts:
         shortcut_lines = [f"`{s}` → `{t}`" for s, t in user_shortcuts.items()]
         embed.add_field(name="Shortcuts", value="\n".join(shortcut_lines), inline=False)
@@ -565,14 +1501,14 @@ async def list_command(interaction: discord.Interaction):
         embed.add_field(name="Shortcuts", value="No shortcuts set.", inline=False)
 
     # Append phrase
-    append_phrase = append_data.get(user_id)
+    append_phrase = data.append.get(user_id)
     if append_phrase:
         embed.add_field(name="Append Phrase", value=f"`{append_phrase}`", inline=False)
     else:
         embed.add_field(name="Append Phrase", value="No append phrase set.", inline=False)
 
     # Delimiter info
-    user_delimiter = delimiters_data.get(user_id)
+    user_delimiter = data.delimiters.get(user_id)
     if user_delimiter:
         embed.add_field(name="Mention Delimiter", value=f"`{user_delimiter}`", inline=False)
     else:
@@ -580,8 +1516,151 @@ async def list_command(interaction: discord.Interaction):
 
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
+# /total
+@bot.tree.command(name="total", description="Show your counters totaled across all channels", guilds=guilds)
+@app_commands.describe(phrase="Only show this phrase (leave empty for all your tracked phrases)")
+async def total_command(interaction: discord.Interaction, phrase: str = None):
+    user_id = str(interaction.user.id)
+    data = get_guild_data(interaction.guild_id)
+    phrases = [phrase] if phrase else data.tracking.get(user_id, [])
+    if not phrases:
+        await interaction.response.send_message("You are not tracking any phrases.", ephemeral=True)
+        return
+    embed = discord.Embed(title=f"{interaction.user.display_name}'s Totals", color=discord.Color.blue())
+    total_lines = []
+    for p in phrases:
+        ranking = data.aggregates.ranking(p)
+        rank = ranking.rank(user_id) if ranking else None
+        line = f"`{p}` X{data.aggregates.total(user_id, p)}"
+        if rank:
+            line += f" (#{rank} in the server)"
+        total_lines.append(line)
+    embed.add_field(name="All Channels", value="\n".join(total_lines), inline=False)
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+# /leaderboard
+LEADERBOARD_SIZE = 10 # Users shown by /leaderboard
+
+@bot.tree.command(name="leaderboard", description="Show who has said a phrase the most", guilds=guilds)
+@app_commands.describe(phrase="The phrase to rank", here="Only count this channel")
+async def leaderboard_command(interaction: discord.Interaction, phrase: str, here: bool = False):
+    user_id = str(interaction.user.id)
+    data = get_guild_data(interaction.guild_id)
+    ranking = data.aggregates.ranking(phrase, str(interaction.channel.id) if here else None)
+    if not ranking or not ranking.scores:
+        await interaction.response.send_message(f"Nobody has said '{phrase}' yet.", ephemeral=True)
+        return
+    scope = "this channel" if here else "the server"
+    embed = discord.Embed(title=f"'{phrase}' Leaderboard", description=f"Top counts in {scope}", color=discord.Color.gold())
+    board_lines = [f"{i}. <@{uid}> X{count}" for i, (uid, count) in enumerate(ranking.top(LEADERBOARD_SIZE), start=1)]
+    rank = ranking.rank(user_id)
+    if rank and rank > LEADERBOARD_SIZE:
+        board_lines.append(f"...\n{rank}. <@{user_id}> X{ranking.scores[user_id]}")
+    embed.add_field(name="Rankings", value="\n".join(board_lines), inline=False)
+    embed.set_footer(text=f"{len(ranking.scores)} users, X{ranking.total} in total")
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+# /recount
+@bot.tree.command(name="recount", description="Rebuild your counters from message history", guilds=guilds)
+@app_commands.describe(here="Only recount this channel")
+async def recount_command(interaction: discord.Interaction, here: bool = False):
+    user_id = str(interaction.user.id)
+    data = get_guild_data(interaction.guild_id)
+    if not data.tracking.get(user_id):
+        await interaction.response.send_message("You are not tracking any phrases!", ephemeral=True)
+        return
+    key = (interaction.guild_id, user_id)
+    if key in recounts:
+        await interaction.response.send_message("Your recount is already running.", ephemeral=True)
+        return
+    if here:
+        channels = [interaction.channel]
+    else:
+        me = interaction.guild.me
+        channels = [c for c in interaction.guild.text_channels if c.permissions_for(me).read_message_history]
+    recount = Recount(data, interaction.user, channels)
+    recounts[key] = recount
+    status = "Resuming" if recount.resumed else "Starting"
+    await interaction.response.send_message(
+        f"{status} your recount of {len(recount.channels)} channel(s). Counters are only ever raised.", ephemeral=True
+    )
+    try:
+        raised = await recount.run()
+    except (discord.HTTPException, OSError) as e:
+        print(f"Recount for {interaction.user} stopped: {e}")
+        await recount.checkpoint()
+        message = "Your recount was interrupted. Run /recount again to resume it."
+    else:
+        message = f"Recount finished: scanned {recount.scanned} messages and raised {raised} counter(s)."
+    finally:
+        del recounts[key]
+    await report_recount(interaction, message)
+
+async def report_recount(interaction, message):
+    # A long recount outlives the interaction's 15 minute token, so the result may have to go
+    # by DM, or to the channel if the user doesn't accept DMs
+    if not interaction.is_expired():
+        try:
+            await interaction.followup.send(message, ephemeral=True)
+            return
+        except discord.HTTPException:
+            pass
+    try:
+        await interaction.user.send(f"{message} ({interaction.guild.name})")
+        return
+    except discord.HTTPException:
+        pass
+    try:
+        await interaction.channel.send(f"{interaction.user.mention} {message}", allowed_mentions=AllowedMentions(users=True))
+    except discord.HTTPException as e:
+        print(f"Failed to report recount result to {interaction.user}: {e}")
+
+# /stats
+STATS_CHANNELS = 5 # Deepest channel queues shown by /stats
+@bot.tree.command(name="stats", description="Show message processing statistics (admin only)", guilds=guilds)
+@app_commands.default_permissions(administrator=True)
+async def stats_command(interaction: discord.Interaction):
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("Only administrators can view stats.", ephemeral=True)
+        return
+    embed = discord.Embed(title="CounterBot Stats", color=discord.Color.orange())
+
+    counts = metrics.counters
+    message_lines = [
+        f"Processed: {counts.get('messages_processed', 0)}",
+        f"Reposted: {counts.get('messages_reposted', 0)}",
+        f"Skipped: {counts.get('messages_skipped', 0)}",
+        f"Failed: {counts.get('repost_failures', 0)}",
+        f"Offloaded: {counts.get('transforms_offloaded', 0)}",
+    ]
+    embed.add_field(name="Messages", value="\n".join(message_lines), inline=False)
+
+    gauges = metric_gauges()
+    queue_lines = [f"{name.replace('_', ' ').capitalize()}: {value}" for name, value in gauges.items()]
+    embed.add_field(name="Queues", value="\n".join(queue_lines), inline=False)
+
+    busiest = [(channel_id, depth) for channel_id, depth in dispatcher.depths()[:STATS_CHANNELS] if depth]
+    if busiest:
+        channel_lines = [
+            f"<#{channel_id}>: {depth} waiting" + (" (saturated)" if channel_id in dispatcher.saturated else "")
+            for channel_id, depth in busiest
+        ]
+        embed.add_field(name="Busiest Channels", value="\n".join(channel_lines), inline=False)
+
+    # Latencies in ms; p50/p99 are histogram bucket upper bounds
+    stage_lines = [f"{'stage':<15}{'count':>7}{'mean':>8}{'p50':>8}{'p99':>8}"]
+    for stage, histogram in sorted(metrics.histograms.items()):
+        stage_lines.append(
+            f"{stage:<15}{histogram.count:>7}{histogram.mean * 1000:>8.2f}"
+            f"{histogram.quantile(0.5) * 1000:>8.2f}{histogram.quantile(0.99) * 1000:>8.2f}"
+        )
+    stage_text = "\n".join(stage_lines) if metrics.histograms else "No messages processed yet."
+    embed.add_field(name="Stage Latency (ms)", value=f"```\n{stage_text}\n```", inline=False)
+
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
 # /help
-@bot.tree.command(name="help", description="Show all commands", guild=guild)
+@bot.tree.command(name="help", description="Show all commands", guilds=guilds)
 async def help_command(interaction: discord.Interaction):
     embed = discord.Embed(title="CounterBot Commands", color=discord.Color.green())
     embed.add_field(name="/track <phrase>", value="Start tracking a phrase.", inline=False)
@@ -593,16 +1672,74 @@ async def help_command(interaction: discord.Interaction):
     embed.add_field(name="/repost [on/off]", value="Toggle reposting messages.", inline=False)
     embed.add_field(name="/reply [on/off]", value="Toggle the new reply quoting mechanic.", inline=False)
     embed.add_field(name="/list", value="List tracked phrases and shortcuts.", inline=False)
+    embed.add_field(name="/total [phrase]", value="Show your counters totaled across all channels.", inline=False)
+    embed.add_field(name="/leaderboard <phrase> [here]", value="Show who has said a phrase the most.", inline=False)
+    embed.add_field(name="/recount [here]", value="Rebuild your counters from message history.", inline=False)
     embed.add_field(name="/delimiter <char>", value="Set your mention delimiter (leave empty to disable).", inline=False)
+    embed.add_field(name="/stats", value="Show message processing statistics (admin only).", inline=False)
     embed.set_footer(text="Counters are per-channel. Messages are reposted only if enabled. See README.md for full details.")
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
+# -------------- Autocomplete --------------
+# Suggestions come from the user's PhraseIndex, so they stay fast with large phrase sets
+AUTOCOMPLETE_CHOICES = 25 # Discord's maximum
+
+def phrase_choices(phrases):
+    # Choice values are capped at 100 characters; longer phrases can still be typed out
+    return [app_commands.Choice(name=phrase, value=phrase) for phrase in phrases if len(phrase) <= 100]
+
+def user_phrase_index(interaction):
+    return get_phrase_index(get_guild_data(interaction.guild_id), str(interaction.user.id))
+
+@track.autocomplete("phrase")
+async def track_autocomplete(interaction: discord.Interaction, current: str):
+    # Phrases the user has shortcuts for but doesn't track yet
+    return phrase_choices(user_phrase_index(interaction).complete_targets(current, AUTOCOMPLETE_CHOICES, untracked=True))
+
+@untrack.autocomplete("phrase")
+@set_counter.autocomplete("phrase")
+async def tracked_phrase_autocomplete(interaction: discord.Interaction, current: str):
+    return phrase_choices(user_phrase_index(interaction).complete_phrases(current, AUTOCOMPLETE_CHOICES))
+
+@shortcut_remove.autocomplete("phrase")
+async def shortcut_target_autocomplete(interaction: discord.Interaction, current: str):
+    return phrase_choices(user_phrase_index(interaction).complete_targets(current, AUTOCOMPLETE_CHOICES))
+
+# -------------- Command Sync --------------
+# Syncing is rate limited, so each guild's commands are only synced when their definitions
+# differ from what was last synced there, according to a hash stored in the guild's directory
+COMMAND_HASH_FILE = "commands.sha256"
+
+def command_hash(command_guild):
+    definitions = [command.to_dict(bot.tree) for command in bot.tree.get_commands(guild=command_guild)]
+    text = json.dumps([bot.application_id, definitions], sort_keys=True)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+async def sync_commands(data, command_guild):
+    path = os.path.join(data.directory, COMMAND_HASH_FILE)
+    digest = command_hash(command_guild)
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            if f.read().strip() == digest:
+                return
+    try:
+        await bot.tree.sync(guild=command_guild)
+    except discord.HTTPException as e:
+        print(f"Failed to sync commands for guild {command_guild.id}: {e}")
+        return
+    write_atomic(path, digest)
+    print(f"Synced commands for guild {command_guild.id}")
+
 # Bot ready
 @bot.event
 async def on_ready():
-    load_all_data()
-    await bot.tree.sync(guild=guild)
-    print(f"Logged in as {bot.user} for guild {GUILD_ID}")
+    if WEBHOOK_PREWARM and not webhooks.webhooks:
+        for guild_id in GUILD_IDS:
+            ready_guild = bot.get_guild(guild_id)
+            if ready_guild:
+                await webhooks.warm(ready_guild)
+    print(f"Logged in as {bot.user} for {len(GUILD_IDS)} guild(s) across {bot.shard_count} shard(s)")
 
 # Start bot
-bot.run(TOKEN)
+if __name__ == "__main__":
+    bot.run(TOKEN)
@@ -0,0 +1,96 @@
+import asyncio
+import time
+
+# -------------- Token Bucket --------------
+class TokenBucket:
+    """Allows `rate` actions per second on average, with bursts of up to `burst`."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.refilled = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    def try_take(self):
+        """Take a token if one is available right now."""
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    async def take(self):
+        """Wait until a token is available, then take it."""
+        while not self.try_take():
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def spend(self):
+        """Take a token even if there are none; the debt is paid back as the bucket refills."""
+        self._refill()
+        self.tokens -= 1
+
+    def available(self):
+        self._refill()
+        return self.tokens
+
+# -------------- Rate Governor --------------
+class RateGovernor:
+    """
+    Client-side view of rate limit buckets (e.g. one per webhook, one per channel).
+    Every request spends a token from its bucket's TokenBucket, sized like Discord's limit,
+    and a 429 empties the bucket for at least `cooldown` seconds. So does a run of
+    `slow_streak` slow responses in a row, which evidently waited 429s out; a single slow
+    round trip is just network latency. A bucket is under pressure while it has fewer than
+    `low_water` tokens left, so callers can back off before Discord starts throttling.
+    """
+    def __init__(self, rate, burst, low_water=1, cooldown=5.0, slow_streak=3):
+        self.rate = rate
+        self.burst = burst
+        self.low_water = low_water
+        self.cooldown = cooldown
+        self.slow_streak = slow_streak
+        self.buckets = {}  # key -> TokenBucket
+        self.limited_until = {}  # key -> monotonic time its last 429 stops counting
+        self.slow = {}  # key -> slow responses in a row
+        self.rate_limits = 0
+
+    def _bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def spend(self, key):
+        """Record a request against key's bucket."""
+        self._bucket(key).spend()
+
+    def rate_limited(self, key, retry_after=0.0):
+        self.rate_limits += 1
+        self.limited_until[key] = time.monotonic() + max(retry_after, self.cooldown)
+        bucket = self._bucket(key)
+        bucket.tokens = min(bucket.available(), 0)
+
+    def responded(self, key, slow):
+        """Record a successful response; enough slow ones in a row count as a 429."""
+        if not slow:
+            self.slow.pop(key, None)
+            return
+        streak = self.slow.get(key, 0) + 1
+        if streak < self.slow_streak:
+            self.slow[key] = streak
+            return
+        del self.slow[key]
+        self.rate_limited(key)
+
+    def pressured(self, key):
+        until = self.limited_until.get(key)
+        if until is not None:
+            if time.monotonic() < until:
+                return True
+            del self.limited_until[key]
+        bucket = self.buckets.get(key)
+        return bucket is not None and bucket.available() < self.low_water
@@ -0,0 +1,380 @@
+import asyncio
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from counters import CounterStore, TieredCounterStore
+
+# -------------- Atomic Writes --------------
+def write_atomic(path, text):
+    """
+    Write text to path so readers only ever see the old or the new file:
+    write a temp file in the same directory, fsync it, then rename it over path.
+    """
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+def dump_json(data):
+    return json.dumps(data, indent=4)
+
+def write_json_atomic(path, data):
+    write_atomic(path, dump_json(data))
+
+# -------------- Storage Backends --------------
+# Every data set maps user IDs to that user's value, except "counters", which is a
+# CounterStore of (user, channel, phrase) -> count, so its changes are tracked per counter.
+COUNTERS = "counters"
+DATASETS = (
+    "tracked_phrases",
+    COUNTERS,
+    "append_phrases",
+    "shortcuts",
+    "repost",
+    "reply",
+    "delimiters",
+)
+
+def load_json(path):
+    if not os.path.exists(path):
+        write_json_atomic(path, {})
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+class JsonBackend:
+    """
+    One JSON file per data set, rewritten whole on every save.
+    Counters are the exception: each save appends the changed counters to an append-only
+    journal, and the journal is only compacted into counters.json every `compact_after` entries.
+    snapshot() runs on the event loop and returns what write() later stores from a worker thread.
+    """
+    def __init__(self, data_dir, compact_after=10000):
+        self.data_dir = data_dir
+        self.compact_after = compact_after
+        self.journal_entries = 0
+
+    def path(self, name):
+        return os.path.join(self.data_dir, f"{name}.json")
+
+    def journal_path(self):
+        return os.path.join(self.data_dir, f"{COUNTERS}.journal")
+
+    def load(self, name):
+        data = load_json(self.path(name))
+        if name == COUNTERS:
+            data = CounterStore.from_dict(data)
+            self.journal_entries = self._replay_journal(data)
+        return data
+
+    def _replay_journal(self, counters):
+        # Each line is [user_id, channel_id, phrase, new_count], applied on top of the snapshot
+        if not os.path.exists(self.journal_path()):
+            return 0
+        entries = 0
+        with open(self.journal_path(), "r+b") as f:
+            journal = f.read()
+            # Drop a torn final line from a crash mid-append, so new entries start on a fresh line
+            complete = journal.rfind(b"\n") + 1
+            if complete < len(journal):
+                f.truncate(complete)
+        for line in journal[:complete].splitlines():
+            try:
+                user_id, channel_id, phrase, count = json.loads(line)
+            except (ValueError, TypeError):
+                continue
+            counters.set(user_id, channel_id, phrase, count)
+            entries += 1
+        return entries
+
+    def snapshot(self, name, data, keys):
+        if name != COUNTERS:
+            return dump_json(data)
+        entries = []
+        for key in keys:
+            if key is None:
+                continue
+            user_id, channel_id, phrase = key
+            count = data.peek(user_id, channel_id, phrase)
+            if count is not None:
+                entries.append(json.dumps([user_id, channel_id, phrase, count]) + "\n")
+        self.journal_entries += len(entries)
+        # A None key means the whole data set changed, which the journal can't express
+        if None in keys or self.journal_entries >= self.compact_after:
+            self.journal_entries = 0
+            return "".join(entries), dump_json(data.to_dict())
+        return "".join(entries), None
+
+    def write(self, name, payload):
+        if name != COUNTERS:
+            write_atomic(self.path(name), payload)
+            return
+        entries, compacted = payload
+        # Journal first: if we crash before truncating it below, replaying it over the
+        # new snapshot still ends on the same counts
+        if entries:
+            with open(self.journal_path(), "a") as f:
+                f.write(entries)
+                f.flush()
+                os.fsync(f.fileno())
+        if compacted is not None:
+            write_atomic(self.path(name), compacted)
+            with open(self.journal_path(), "w") as f:
+                os.fsync(f.fileno())
+
+    def close(self):
+        pass
+
+class SqliteBackend:
+    """
+    SQLite database in WAL mode. Saves only the rows that changed: one row per user
+    for settings, one row per (user, channel, phrase) for counters.
+    Existing JSON files in data_dir are imported the first time the database is opened.
+    With counter_cache set, counters load as a TieredCounterStore holding at most that
+    many (user, channel) tables in memory; the rest are read back from the database on use.
+    """
+    def __init__(self, path, data_dir=None, counter_cache=None):
+        self.path = path
+        self.counter_cache = counter_cache
+        # Writes happen from the write-behind worker thread, serialized by its lock
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS counters ("
+                "user_id TEXT NOT NULL, channel_id TEXT NOT NULL, phrase TEXT NOT NULL, count INTEGER NOT NULL, "
+                "PRIMARY KEY (user_id, channel_id, phrase)) WITHOUT ROWID"
+            )
+            # For channel leaderboards, which read one channel's counters
+            self.db.execute("CREATE INDEX IF NOT EXISTS counters_by_channel ON counters (channel_id)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS settings ("
+                "name TEXT NOT NULL, user_id TEXT NOT NULL, value TEXT NOT NULL, "
+                "PRIMARY KEY (name, user_id)) WITHOUT ROWID"
+            )
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        if data_dir is not None:
+            self.migrate_json(JsonBackend(data_dir))
+        # Page-ins happen on the event loop; WAL lets this connection read while the
+        # worker thread writes, and it only ever sees committed rows
+        self.reader = sqlite3.connect(path, check_same_thread=False) if counter_cache else None
+
+    def migrate_json(self, json_backend):
+        if self.db.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+            return
+        imported = []
+        with self.db:
+            for name in DATASETS:
+                if os.path.exists(json_backend.path(name)):
+                    data = json_backend.load(name)
+                    self._write(name, self.snapshot(name, data, {None}))
+                    imported.append(name)
+            self.db.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', '1')")
+        if imported:
+            print(f"Imported {', '.join(imported)} from {json_backend.data_dir} into {self.path}")
+
+    def load(self, name):
+        if name == COUNTERS:
+            if self.counter_cache:
+                return TieredCounterStore(self._load_counter_table, self.counter_cache, self._load_counter_channel)
+            return CounterStore.from_rows(
+                self.db.execute("SELECT user_id, channel_id, phrase, count FROM counters")
+            )
+        data = {}
+        for user_id, value in self.db.execute(
+            "SELECT user_id, value FROM settings WHERE name = ?", (name,)
+        ):
+            data[user_id] = json.loads(value)
+        return data
+
+    def counter_rows(self):
+        """Stream every stored counter as (user_id, channel_id, phrase, count) without loading them all."""
+        return (self.reader or self.db).execute("SELECT user_id, channel_id, phrase, count FROM counters")
+
+    def _load_counter_channel(self, channel_id):
+        return self.reader.execute("SELECT user_id, phrase, count FROM counters WHERE channel_id = ?", (channel_id,))
+
+    def _load_counter_table(self, user_id, channel_id):
+        return self.reader.execute(
+            "SELECT phrase, count FROM counters WHERE user_id = ? AND channel_id = ?", (user_id, channel_id)
+        ).fetchall()
+
+    def snapshot(self, name, data, keys):
+        # A None key means the whole data set changed
+        if None in keys:
+            if name == COUNTERS:
+                # Only what's in memory can be written; a tiered store's other tables are already on disk
+                return data.complete, list(data.rows())
+            return True, self._rows(name, data, list(data))
+        return False, self._rows(name, data, keys)
+
+    def _rows(self, name, data, keys):
+        # None values mean the row was deleted
+        if name == COUNTERS:
+            return [
+                (user_id, channel_id, phrase, data.peek(user_id, channel_id, phrase))
+                for user_id, channel_id, phrase in keys
+            ]
+        return [
+            (user_id, json.dumps(data[user_id]) if user_id in data else None)
+            for user_id in keys
+        ]
+
+    def write(self, name, payload):
+        with self.db:
+            self._write(name, payload)
+
+    def _write(self, name, payload):
+        replace_all, rows = payload
+        if name == COUNTERS:
+            if replace_all:
+                self.db.execute("DELETE FROM counters")
+            self.db.executemany(
+                "INSERT INTO counters (user_id, channel_id, phrase, count) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (user_id, channel_id, phrase) DO UPDATE SET count = excluded.count",
+                [row for row in rows if row[3] is not None]
+            )
+            self.db.executemany(
+                "DELETE FROM counters WHERE user_id = ? AND channel_id = ? AND phrase = ?",
+                [row[:3] for row in rows if row[3] is None]
+            )
+        else:
+            if replace_all:
+                self.db.execute("DELETE FROM settings WHERE name = ?", (name,))
+            self.db.executemany(
+                "INSERT INTO settings (name, user_id, value) VALUES (?, ?, ?) "
+                "ON CONFLICT (name, user_id) DO UPDATE SET value = excluded.value",
+                [(name, user_id, value) for user_id, value in rows if value is not None]
+            )
+            self.db.executemany(
+                "DELETE FROM settings WHERE name = ? AND user_id = ?",
+                [(name, user_id) for user_id, value in rows if value is None]
+            )
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+        self.db.close()
+
+# -------------- Write-Behind Persistence --------------
+class WriteBehind:
+    """
+    Marks data sets dirty and saves them later from a background task, either every
+    `interval` seconds or as soon as `threshold` changes have piled up. Changes are
+    snapshotted on the event loop (so they're consistent) and written by the backend
+    from a worker thread (so disk I/O doesn't block it).
+    """
+    def __init__(self, backend, interval=5.0, threshold=100, on_flush=None):
+        self.backend = backend
+        self.on_flush = on_flush  # Called with the seconds each background flush took
+        self.interval = interval
+        self.threshold = threshold
+        self.sources = {}  # data set name -> callable returning the current data
+        self.checkpoints = {}  # data set name -> callable run at snapshot time, see register()
+        self.dirty = {}  # data set name -> changed keys (None means everything)
+        self.changes = 0
+        self._write_lock = threading.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._wake = None
+        self._task = None
+        self._stopping = False
+
+    def register(self, name, source, checkpoint=None):
+        """
+        checkpoint, if given, is called whenever the data set is snapshotted and may return
+        a callable, which is run on the event loop once that snapshot has been written.
+        """
+        self.sources[name] = source
+        if checkpoint is not None:
+            self.checkpoints[name] = checkpoint
+
+    def mark_dirty(self, name, key=None):
+        """Record a change to one key of a data set: a user ID, or a (user, channel, phrase) counter."""
+        self.dirty.setdefault(name, set()).add(key)
+        self.changes += 1
+        if self.changes >= self.threshold and self._wake:
+            self._wake.set()
+
+    def _take_pending(self):
+        pending = []
+        for name, keys in self.dirty.items():
+            checkpoint = self.checkpoints.get(name)
+            on_saved = checkpoint() if checkpoint else None
+            pending.append((name, keys, self.backend.snapshot(name, self.sources[name](), keys), on_saved))
+        self.dirty = {}
+        self.changes = 0
+        return pending
+
+    def _write_pending(self, pending):
+        failed = []
+        with self._write_lock:
+            for name, keys, payload, _ in pending:
+                try:
+                    self.backend.write(name, payload)
+                except (OSError, sqlite3.Error) as e:
+                    print(f"Failed to save {name}: {e}")
+                    failed.append(name)
+        return failed
+
+    def _finish(self, pending, failed):
+        for name, keys, _, on_saved in pending:
+            if name in failed:
+                self.dirty.setdefault(name, set()).update(keys)
+            elif on_saved:
+                on_saved()
+
+    def flush(self):
+        """Synchronously write every dirty data set."""
+        pending = self._take_pending()
+        self._finish(pending, self._write_pending(pending))
+
+    async def flush_async(self):
+        # One at a time, so snapshots reach the backend in the order they were taken; an older
+        # snapshot written after a newer one would overwrite newer counts
+        async with self._flush_lock:
+            if not self.dirty:
+                return
+            started = time.perf_counter()
+            pending = self._take_pending()
+            self._finish(pending, await asyncio.to_thread(self._write_pending, pending))
+            if self.on_flush:
+                self.on_flush(time.perf_counter() - started)
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush_async()
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background task and write everything still dirty."""
+        if self._task is not None:
+            self._stopping = True
+            self._wake.set()
+            await self._task
+            self._task = None
+        # After any flush still writing, e.g. one a /recount started
+        async with self._flush_lock:
+            self.flush()